@@ -0,0 +1,230 @@
+"""Офлайн-бенчмарк парсеров на записанных ответах сайтов.
+
+Фикстуры из benchmarks/fixtures/ отдаёт локальный HTTP-сервер: общий клиент parsers.common
+ходит к нему вместо настоящих хостов, так что сеть и авторизация не нужны. Для каждого
+случая меряется время одного вызова (лучшее из нескольких повторов, как в timeit),
+память, оставшаяся выделенной после вызова, и пик памяти во время вызова (tracemalloc).
+
+    python benchmarks/run.py                  # прогон
+    python benchmarks/run.py --save           # сохранить результаты как baseline
+    python benchmarks/run.py --compare        # сравнить с baseline; код возврата 1 при регрессии
+    python benchmarks/run.py -k pikabu        # только случаи, в имени которых есть подстрока
+
+Фикстура — тело ответа сайта как есть: чтобы обновить, сохрани страницу (ответ API) под тем же
+именем. Baseline зависит от машины и версии Python, поэтому в репозиторий не коммитится.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import sys
+import threading
+import timeit
+import tracemalloc
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx
+
+from parsers import common, pikabu, pinterest, reddit, twitter
+
+
+FIXTURES_DIR = os.path.join(ROOT, 'benchmarks', 'fixtures')
+BASELINE_PATH = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+USER = SimpleNamespace(full_name='Тестовый Пользователь')
+TWEET_ID = '1791361234567890123'
+PIKABU_URL = 'https://pikabu.ru/story/kogda_pyatnitsa_a_tyi_na_rabote_11432123'
+PIN_IMAGE_URL = 'https://www.pinterest.com/pin/112001234567890123/'
+PIN_VIDEO_URL = 'https://www.pinterest.com/pin/112009876543210987/'
+TWEET_URL = f'https://x.com/memesender/status/{TWEET_ID}'
+MPD_URL = 'https://v.redd.it/abcdef123456/DASHPlaylist.mpd'
+
+# Что отдаёт локальный сервер: '<host><path>' -> (фикстура, Content-Type)
+ROUTES = {
+    'pikabu.ru/story/kogda_pyatnitsa_a_tyi_na_rabote_11432123': ('pikabu_story.html', 'text/html; charset=utf-8'),
+    'www.pinterest.com/pin/112001234567890123/': ('pinterest_image.html', 'text/html; charset=utf-8'),
+    'www.pinterest.com/pin/112009876543210987/': ('pinterest_video.html', 'text/html; charset=utf-8'),
+    'cdn.syndication.twimg.com/tweet-result': ('tweet.json', 'application/json'),
+    'v.redd.it/abcdef123456/DASHPlaylist.mpd': ('reddit_dash.mpd', 'application/dash+xml'),
+}
+
+# name — имя в отчёте и baseline; run() — один вызов измеряемой функции.
+Case = namedtuple('Case', 'name run')
+
+
+class _FixtureHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        route = ROUTES.get(self.path.lstrip('/').split('?')[0])
+        if route is None:
+            self.send_error(404)
+            return
+        fixture, content_type = route
+        with open(os.path.join(FIXTURES_DIR, fixture), 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _LocalTransport(httpx.AsyncBaseTransport):
+    """Переписать https://host/path в http://127.0.0.1:port/host/path — на локальный сервер."""
+
+    def __init__(self, port):
+        self._port = port
+        self._transport = httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request):
+        url = request.url
+        request.url = url.copy_with(scheme='http', host='127.0.0.1', port=self._port, path=f'/{url.host}{url.path}')
+        return await self._transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def start_fixture_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _FixtureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def _collect(result):
+    title, content = await result
+    return title, [block async for block in content]
+
+
+def build_cases(loop):
+    def fetch(url, **kwargs):
+        return loop.run_until_complete(common.http_get(url, **kwargs)).content
+
+    pikabu_html = fetch(PIKABU_URL).decode()
+    pin_image_html = fetch(PIN_IMAGE_URL).decode()
+    pin_video_html = fetch(PIN_VIDEO_URL).decode()
+    tweet_body = fetch(twitter._SYNDICATION_URL, params={'id': TWEET_ID})
+    mpd_body = fetch(MPD_URL)
+    title = "Когда в пятницу [18+] вечером прилетает «срочная задачка на 5 минут» (от начальника) #мемы!"
+
+    def e2e(func, url):
+        return lambda: loop.run_until_complete(_collect(func(url, USER)))
+
+    return [
+        Case('pikabu._parse_pikabu_page', lambda: pikabu._parse_pikabu_page(pikabu_html, PIKABU_URL, USER)),
+        Case('pinterest._parse_pinterest_page[image]',
+             lambda: pinterest._parse_pinterest_page(pin_image_html, PIN_IMAGE_URL, USER)),
+        Case('pinterest._parse_pinterest_page[video]',
+             lambda: pinterest._parse_pinterest_page(pin_video_html, PIN_VIDEO_URL, USER)),
+        Case('twitter._parse_tweet', lambda: twitter._parse_tweet(json.loads(tweet_body), TWEET_ID, TWEET_URL, USER)),
+        Case('twitter._syndication_token', lambda: twitter._syndication_token(TWEET_ID)),
+        Case('reddit.parse_mpd_file', lambda: reddit.parse_mpd_file(mpd_body)),
+        Case('common.escape_markdown', lambda: common.escape_markdown(title)),
+        Case('common.generate_title', lambda: common.generate_title(USER, PIKABU_URL, title)),
+        # Полный путь через общий HTTP-клиент и локальный сервер: запрос, разбор, блоки.
+        Case('pikabu.get_pikabu_content[http]', e2e(pikabu.get_pikabu_content, PIKABU_URL)),
+        Case('pinterest.get_pinterest_content[http]', e2e(pinterest.get_pinterest_content, PIN_VIDEO_URL)),
+        Case('twitter.get_x_content[http]', e2e(twitter.get_x_content, TWEET_URL)),
+    ]
+
+
+def measure(case, repeat):
+    """{'us': мкс на вызов, 'alloc_kib': осталось выделенным после вызова и сборки мусора,
+    'peak_kib': пик во время вызова}."""
+    timer = timeit.Timer(case.run)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat, number)) / number
+
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        result = case.run()
+        _, peak = tracemalloc.get_traced_memory()
+        gc.collect()  # дерево BeautifulSoup — циклический мусор, без сборки оно выглядит утечкой
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return {'us': round(best * 1e6, 2), 'alloc_kib': round((after - before) / 1024, 1),
+            'peak_kib': round((peak - before) / 1024, 1)}
+
+
+def _delta(new, old):
+    if not old:
+        return ''
+    return f'{(new - old) / old * 100:+.0f}%'
+
+
+def report(results, baseline=None, threshold=10.0):
+    """Напечатать таблицу; вернуть имена случаев, которые медленнее baseline больше чем на threshold %."""
+    baseline = baseline or {}
+    regressions = []
+    name_width = max(len(name) for name in results)
+    print(f"{'случай':<{name_width}}  {'мкс/вызов':>12}  {'осталось КБ':>11}  {'пик КБ':>9}")
+    for name, r in results.items():
+        old = baseline.get(name)
+        line = f"{name:<{name_width}}  {r['us']:>12.2f}  {r['alloc_kib']:>11.1f}  {r['peak_kib']:>9.1f}"
+        if old:
+            line += f"  время {_delta(r['us'], old['us']):>5}, пик {_delta(r['peak_kib'], old['peak_kib']) or '—':>5}"
+            if r['us'] > old['us'] * (1 + threshold / 100):
+                regressions.append(name)
+                line += '  РЕГРЕССИЯ'
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='pattern', help='только случаи с этой подстрокой в имени')
+    parser.add_argument('--repeat', type=int, default=5, help='повторов замера времени (берётся лучший)')
+    parser.add_argument('--save', action='store_true', help='сохранить результаты как baseline')
+    parser.add_argument('--compare', action='store_true', help='сравнить с baseline')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='путь к baseline (JSON)')
+    parser.add_argument('--threshold', type=float, default=10.0, help='допустимое замедление, %%')
+    args = parser.parse_args()
+
+    server = start_fixture_server()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    common._http_client = httpx.AsyncClient(
+        headers=common.build_http_headers(), transport=_LocalTransport(server.server_address[1]),
+    )
+    try:
+        cases = [c for c in build_cases(loop) if not args.pattern or args.pattern in c.name]
+        results = {case.name: measure(case, args.repeat) for case in cases}
+    finally:
+        loop.run_until_complete(common.close_http_client())
+        loop.close()
+        server.shutdown()
+
+    baseline = None
+    if args.compare:
+        with open(args.baseline, encoding='utf-8') as f:
+            saved = json.load(f)
+        print(f"baseline: {saved['python']}, {saved['machine']}")
+        baseline = saved['results']
+    regressions = report(results, baseline, args.threshold)
+
+    if args.save:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'results': results},
+                      f, ensure_ascii=False, indent=2)
+        print(f"baseline сохранён в {args.baseline}")
+    if regressions:
+        print(f"Медленнее baseline больше чем на {args.threshold:g}%: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""Маршрутизация ссылок из сообщения к парсерам по хосту.
+
+Вместо прогона регулярки каждого парсера по всему тексту: один проход общей регуляркой
+URL, затем поиск хоста в таблице. Регулярка парсера применяется только к самой ссылке —
+как проверка пути (например, что это пост, а не профиль).
+
+Микробенчмарк стоимости разбора одного сообщения:
+    python dispatcher.py
+"""
+import re
+import timeit
+from urllib.parse import unquote
+
+from parsers.common import canonical_url
+
+
+# Хост + необязательный путь. Lookbehind не даёт начать совпадение посреди слова или
+# %-последовательности (https%3A%2F%2Fpikabu.ru — такие ссылки разбираются после unquote).
+_URL_REGEX = re.compile(
+    r'(?<![\w%.@-])(?:https?://)?((?:[a-z0-9-]+\.)+[a-z]{2,})(?::\d+)?(?:/[^\s<>"]*)?',
+    re.IGNORECASE,
+)
+_QUOTED_URL_MARK = '%3A%2F%2F'
+
+
+class LinkDispatcher:
+    """Находит в сообщении все ссылки и сопоставляет их включённым парсерам.
+
+    specs — объекты с полями regex, hosts, enabled. Хост 'pinterest.*' означает домен
+    второго уровня с любой зоной (pinterest.com, pinterest.co.uk, ...).
+    """
+
+    def __init__(self, specs):
+        self._hosts = {}
+        self._brands = {}
+        for spec in specs:
+            if not spec.enabled:
+                continue
+            route = (spec, re.compile(spec.regex, re.IGNORECASE))
+            for host in spec.hosts:
+                if host.endswith('.*'):
+                    self._brands[host[:-2]] = route
+                else:
+                    self._hosts[host] = route
+
+    def _route(self, host):
+        labels = host.lower().split('.')
+        for i in range(len(labels) - 1):
+            route = self._hosts.get('.'.join(labels[i:]))
+            if route:
+                return route
+        for label in labels[:-1]:
+            route = self._brands.get(label)
+            if route:
+                return route
+        return None
+
+    def _scan(self, text, found, seen):
+        for m in _URL_REGEX.finditer(text):
+            route = self._route(m.group(1))
+            if route is None:
+                continue
+            spec, pattern = route
+            link = pattern.search(m.group(0))
+            if not link:
+                continue
+            key = canonical_url(link.group(0))
+            if key not in seen:
+                seen.add(key)
+                found.append((spec, link.group(0)))
+
+    def dispatch(self, text):
+        """[(spec, link), ...] в порядке появления в тексте, без повторов одного поста."""
+        if '.' not in text:
+            return []
+        found, seen = [], set()
+        self._scan(text, found, seen)
+        if _QUOTED_URL_MARK in text.upper():
+            self._scan(unquote(text), found, seen)
+        return found
+
+
+def benchmark(dispatcher, messages, number=20000):
+    """Средняя стоимость dispatch() одного сообщения, мкс."""
+    total = timeit.timeit(lambda: [dispatcher.dispatch(m) for m in messages], number=number)
+    return total / (number * len(messages)) * 1e6
+
+
+if __name__ == '__main__':
+    from collections import namedtuple
+
+    from parsers.sources import SOURCES
+
+    Spec = namedtuple('Spec', 'regex hosts enabled')
+    specs = [Spec(source.regex, source.hosts, True) for source in SOURCES]
+    chatter = [
+        "ну и где мем?",
+        "завтра в 7 у метро, не опаздывай",
+        "ахаха ну это база, т.е. классика",
+        "глянь youtube.com/watch?v=dQw4w9WgXcQ пока не удалили",
+        "https://docs.python.org/3/library/re.html вот тут написано",
+    ]
+    links = [
+        "https://x.com/someone/status/1790000000000000000",
+        "смотри https://www.instagram.com/reel/C7abcDEF123/?igsh=xyz и https://www.reddit.com/r/memes/s/AbCdEf",
+    ]
+    dispatcher = LinkDispatcher(specs)
+    legacy = lambda text: [s for s in specs if re.search(s.regex, text, re.IGNORECASE)]
+    for title, messages in (("обычная переписка", chatter), ("сообщения со ссылками", links)):
+        legacy_us = timeit.timeit(lambda: [legacy(m) for m in messages], number=20000) / (20000 * len(messages)) * 1e6
+        print(f"{title}: dispatcher {benchmark(dispatcher, messages):.2f} мкс/сообщение, "
+              f"перебор регулярок {legacy_us:.2f} мкс/сообщение")
@@ -0,0 +1,140 @@
+"""Задачи по ссылкам на диске (SQLite WAL): рестарт посреди скачивания или отправки их не теряет.
+
+Задача — одно сообщение со ссылками. Для неё хранится, на какой ссылке остановились, в каком
+состоянии (parse → download → send → done) и сколько частей поста уже доставлено: заголовок,
+затем блоки по порядку. После рестарта незавершённые задачи продолжаются с первой недоставленной
+части; часть, которая отправлялась в момент падения, может прийти повторно.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from parsers.common import logger
+
+
+PARSE, DOWNLOAD, SEND, DONE, FAILED = 'parse', 'download', 'send', 'done', 'failed'
+
+# update — Update в JSON; links — [[label, link], ...]; link_index — текущая ссылка; progress —
+# сколько частей текущей ссылки доставлено; delivered — в чат уже что-то ушло.
+Job = namedtuple('Job', 'id chat_id update links link_index progress state delivered attempts')
+
+
+class JobStore:
+    """Очередь задач в SQLite. Пустой path выключает её: задачи живут только в памяти.
+
+    keep — сколько секунд хранить завершённые задачи; max_attempts — после стольких
+    возобновлений задача считается ядовитой (роняет бота) и помечается failed.
+    """
+
+    def __init__(self, path, keep=24 * 3600, max_attempts=3):
+        self.keep = keep
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = None
+        if not path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, update_json TEXT NOT NULL, "
+            "links TEXT NOT NULL, link_index INTEGER NOT NULL DEFAULT 0, progress INTEGER NOT NULL DEFAULT 0, "
+            "state TEXT NOT NULL, delivered INTEGER NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0, "
+            "updated REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+
+    @property
+    def enabled(self):
+        return self._conn is not None
+
+    def add(self, chat_id, update, links):
+        """Записать новую задачу. update — dict (Update.to_dict()), links — [(label, link), ...]."""
+        job = Job(None, chat_id, update, [list(link) for link in links], 0, 0, PARSE, False, 0)
+        if not self.enabled:
+            return job
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO jobs (chat_id, update_json, links, state, updated) VALUES (?, ?, ?, ?, ?)",
+                (chat_id, json.dumps(update, ensure_ascii=False), json.dumps(job.links, ensure_ascii=False),
+                 PARSE, now),
+            )
+            self._conn.execute(
+                "DELETE FROM jobs WHERE state IN (?, ?) AND updated < ?", (DONE, FAILED, now - self.keep),
+            )
+        return job._replace(id=cursor.lastrowid)
+
+    def pending(self):
+        """Незавершённые задачи по порядку поступления; каждый вызов — ещё одна попытка."""
+        if not self.enabled:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, chat_id, update_json, links, link_index, progress, state, delivered, attempts "
+                "FROM jobs WHERE state NOT IN (?, ?) ORDER BY id", (DONE, FAILED),
+            ).fetchall()
+        jobs = []
+        for row in rows:
+            job = Job(row[0], row[1], json.loads(row[2]), json.loads(row[3]), *row[4:7], bool(row[7]), row[8] + 1)
+            if job.attempts > self.max_attempts:
+                logger.warning("Задача %s в чате %s брошена после %s попыток", job.id, job.chat_id, self.max_attempts)
+                self.finish(job.id, FAILED)
+                continue
+            with self._lock:
+                self._conn.execute("UPDATE jobs SET attempts = ? WHERE id = ?", (job.attempts, job.id))
+            jobs.append(job)
+        return jobs
+
+    def advance(self, job_id, link_index, progress, state, delivered=False):
+        if not self.enabled or job_id is None:
+            return
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET link_index = ?, progress = ?, state = ?, delivered = MAX(delivered, ?), "
+                "updated = ? WHERE id = ?",
+                (link_index, progress, state, int(delivered), time.time(), job_id),
+            )
+
+    def finish(self, job_id, state=DONE):
+        if not self.enabled or job_id is None:
+            return
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET state = ?, updated = ? WHERE id = ?", (state, time.time(), job_id))
+
+    def counts(self):
+        """{(state,): число задач} — для метрик."""
+        if not self.enabled:
+            return {}
+        with self._lock:
+            rows = self._conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return {(state,): n for state, n in rows}
+
+    def close(self):
+        if self.enabled:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
+
+
+class JobProgress:
+    """Ход одной ссылки задачи: сколько частей доставлено (done) и отметки в JobStore."""
+
+    def __init__(self, store, job_id, link_index, done=0):
+        self._store = store
+        self._job_id = job_id
+        self._link_index = link_index
+        self.done = done
+
+    def state(self, state):
+        self._store.advance(self._job_id, self._link_index, self.done, state)
+
+    def sent(self):
+        """Очередная часть (заголовок или блок) отправлена — при возобновлении её пропустим."""
+        self.done += 1
+        self._store.advance(self._job_id, self._link_index, self.done, SEND, delivered=True)
@@ -1,17 +1,24 @@
+import os
 import sys
+import time
+
+_STARTED = time.perf_counter()
 
-sys.dont_write_bytecode = True  # не плодить __pycache__ в проекте
+# Байткод кэшируется вне дерева проекта: в PYTHONPYCACHEPREFIX, если он задан, иначе в ~/.cache.
+if sys.pycache_prefix is None:
+    sys.pycache_prefix = os.path.join(os.path.expanduser('~'), '.cache', 'trash_meme_bot', 'pycache')
 
 import asyncio
+import contextlib
 import logging
-import os
-import re
+import secrets
+import signal
 from collections import namedtuple
+from urllib.parse import urlsplit
 
-import requests
 from dotenv import load_dotenv
-from telegram import Update
-from telegram.error import NetworkError, RetryAfter, TimedOut
+from telegram import InputFile, InputMediaPhoto, InputMediaVideo, Update
+from telegram.error import BadRequest, NetworkError, TimedOut
 from telegram.ext import ApplicationBuilder, ContextTypes, MessageHandler, filters
 from telegram.request import HTTPXRequest
 
@@ -32,85 +39,454 @@ if not TOKEN:
     raise RuntimeError("TELEGRAM_TOKEN не задан в .env")
 
 # imported after load_dotenv() because parsers read env at module init
-from parsers import instagram, pikabu, pinterest, reddit, twitter
-from parsers.common import TEMP_DIR, generate_random_string
-
+from parsers import metrics, sources
+from parsers.cache import FILE_CACHE_PATH, PersistentCache
+from parsers.common import (
+    SPOOL, TELEGRAM_API_URL, TELEGRAM_LOCAL_MODE, UPLOAD_SIZE_CAP, ContentUnavailable, canonical_url,
+    close_http_client, download_to_spool, iter_blocks, probe_size, replace_title_user,
+)
+from parsers.media import fit_video
+from dispatcher import LinkDispatcher
+from jobs import DOWNLOAD, FAILED, PARSE, JobProgress, JobStore
+from scheduler import ChatScheduler
+from sender import TELEGRAM_TEXT_LIMIT, SendScheduler, StreamingUploader, StreamUpload, not_delivered
+from webhook import WebhookServer
+
+_IMPORTED = time.perf_counter()
+
+
+# check_links читает только новые сообщения — другие типы обновлений Telegram присылать не нужно.
+ALLOWED_UPDATES = [Update.MESSAGE]
+
+# Webhook вместо long polling, если задан WEBHOOK_URL — публичный https-адрес для Telegram. Локальный
+# сервер слушает WEBHOOK_LISTEN:WEBHOOK_PORT (обычно за обратным прокси с TLS). Секрет без WEBHOOK_SECRET
+# случайный на каждый запуск: set_webhook при старте всё равно сообщает его Telegram.
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
 
 SEND_TIMEOUTS = dict(read_timeout=120, write_timeout=120, connect_timeout=120, pool_timeout=120)
-TELEGRAM_TEXT_LIMIT = 4096
+
+# Повторно присланные посты и медиа отправляются по file_id, без скачивания и загрузки.
+# Ключи: post:<канонический URL поста> и media:<URL источника>.
+FILE_CACHE = PersistentCache(
+    FILE_CACHE_PATH,
+    'file_ids',
+    ttl=int(os.getenv('FILE_CACHE_TTL_DAYS', '30')) * 24 * 3600,
+    max_entries=int(os.getenv('FILE_CACHE_MAX_ENTRIES', '5000')),
+)
+
+# Ссылки, которые источник назвал удалёнными или приватными, UNAVAILABLE_TTL секунд получают тот же
+# ответ без обращения к нему.
+UNAVAILABLE = PersistentCache(
+    FILE_CACHE_PATH, 'unavailable_links', ttl=int(os.getenv('UNAVAILABLE_TTL', '600')), max_entries=1000,
+)
+# Пост, присланный сразу в несколько чатов, разбирается и скачивается один раз: остальные ждут
+# первую обработку (не дольше FLIGHT_WAIT секунд) и отправляют его по file_id из FILE_CACHE.
+# Ждут только обработку, до которой дошла очередь в её сообщении (turn): иначе два чата с теми же
+# ссылками в разном порядке ждали бы друг друга.
+FLIGHT_WAIT = float(os.getenv('FLIGHT_WAIT', '60'))
+Flight = namedtuple('Flight', 'landed turn')
+_FLIGHTS = {}
+
+# Видео по URL Telegram скачивает сам (до 20 МБ) — без нашего трафика и загрузки. Какие хосты
+# он принимает, запоминается: ключ — домен второго уровня, значение — [принято, отказано].
+SEND_VIDEO_BY_URL = bool(int(os.getenv('SEND_VIDEO_BY_URL', '1')))
+URL_VIDEO_SIZE_CAP = 20 * 1024 * 1024
+URL_HOSTS = PersistentCache(FILE_CACHE_PATH, 'url_video_hosts', ttl=7 * 24 * 3600, max_entries=1000)
+# Остальные mp4 в пределах лимита загрузки идут потоком: ответ источника сразу уходит в Telegram,
+# без временного файла. Файл качается на диск, только если потоковая отправка не удалась.
+SEND_VIDEO_STREAMING = bool(int(os.getenv('SEND_VIDEO_STREAMING', '1')))
+
+# Сообщения со ссылками пишутся в очередь на диске и после рестарта дообрабатываются с места остановки.
+JOBS = JobStore(os.getenv(
+    'JOB_QUEUE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs.sqlite3'),
+))
+metrics.JOB_STATES.callback = JOBS.counts
+
+# Ссылки из разных чатов обрабатываются параллельно, внутри одного чата — в порядке отправки.
+SCHEDULER = ChatScheduler(
+    max_workers=int(os.getenv('MAX_WORKERS', '4')),
+    queue_size=int(os.getenv('CHAT_QUEUE_SIZE', '20')),
+    source_limit=int(os.getenv('SOURCE_MAX_INFLIGHT', '2')),
+)
+metrics.QUEUE_DEPTH.callback = SCHEDULER.depth
+
+# Все вызовы Bot API — через SENDER: лимиты Telegram на бота, группу и личный чат.
+SENDER = SendScheduler(
+    global_rate=float(os.getenv('SEND_GLOBAL_PER_SECOND', '30')),
+    group_per_minute=float(os.getenv('SEND_GROUP_PER_MINUTE', '20')),
+    private_rate=float(os.getenv('SEND_PRIVATE_PER_SECOND', '1')),
+)
 
 
 def _chunk_text(text, limit=TELEGRAM_TEXT_LIMIT):
     return [text[i:i + limit] for i in range(0, len(text), limit)] or [text]
 
 
-ParserSpec = namedtuple('ParserSpec', 'regex enabled func label auth_exc auth_msg', defaults=(None, None))
+# Модули парсеров импортируются лениво — см. parsers/sources.py. PARSERS_PRELOAD=1 — сразу после
+# старта догрузить включённые в фоне, чтобы первая ссылка не ждала импорта.
+PARSERS = sources.SOURCES
+PARSERS_PRELOAD = bool(int(os.getenv('PARSERS_PRELOAD', '1')))
+
+DISPATCHER = LinkDispatcher(PARSERS)
+
 
-PARSERS = [
-    ParserSpec(pikabu.PIKABU_REGEX, pikabu.PARSE_PIKABU, pikabu.get_pikabu_content, 'Pikabu'),
-    ParserSpec(reddit.REDDIT_REGEX, reddit.PARSE_REDDIT, reddit.get_reddit_content, 'Reddit'),
-    ParserSpec(twitter.X_REGEX, twitter.PARSE_X, twitter.get_x_content, 'Twitter/X'),
-    ParserSpec(pinterest.PINTEREST_REGEX, pinterest.PARSE_PINTEREST, pinterest.get_pinterest_content, 'Pinterest'),
-    ParserSpec(
-        instagram.INSTAGRAM_REGEX, instagram.PARSE_INSTAGRAM, instagram.get_instagram_content, 'Instagram',
-        instagram.InstagramAuthRequired, 'Этот контент требует авторизации',
-    ),
-]
+async def retry_send_message(bot, chat_id, text, **kwargs):
+    return await SENDER.call(bot, 'send_message', chat_id, text=text, **kwargs)
+
+
+MEDIA_GROUP_LIMIT = 10
+# Сколько блоков контента готовится (скачивается) впереди отправки.
+PIPELINE_LOOKAHEAD = int(os.getenv('PIPELINE_LOOKAHEAD', '2'))
+
+# Единица медиа в блоке. source: 'url' | 'file' (файл спула) | 'bytes' (небольшое медиа в памяти) | 'file_id'
+# | 'stream' (видео, которое качается из источника прямо во время загрузки в Telegram);
+# url — исходный адрес, по нему кэшируется file_id и делается повторная попытка.
+MediaItem = namedtuple('MediaItem', 'kind source value url', defaults=(None,))
 
 
-def _stream_to_temp(url, ext='.mp4'):
-    out_path = os.path.join(TEMP_DIR, f"download_{generate_random_string()}{ext}")
-    success = False
+def _file_ref(message):
+    """(kind, file_id) отправленного медиа — то, что кладём в FILE_CACHE."""
+    if message is None:
+        return None
+    if message.photo:
+        return 'photo', message.photo[-1].file_id
+    for kind in ('video', 'animation', 'document'):
+        media = getattr(message, kind)
+        if media:
+            return kind, media.file_id
+    return None
+
+
+def _remember(refs, item, message):
+    ref = _file_ref(message)
+    if not ref:
+        return
+    refs.append(list(ref))
+    if item.url and item.source != 'file_id':
+        FILE_CACHE.set(f'media:{item.url}', ref)
+
+
+def _local_source(data):
+    return 'bytes' if isinstance(data, bytes) else 'file'
+
+
+def _block_items(block):
+    return (
+        [MediaItem('photo', 'url', u, u) for u in block.get('images') or []]
+        + [MediaItem('video', 'url', u, u) for u in block.get('videos') or []]
+        + [MediaItem('photo', _local_source(p), p) for p in block.get('image_files') or []]
+        + [MediaItem('video', _local_source(p), p) for p in block.get('video_files') or []]
+        + [MediaItem(kind, 'file_id', file_id) for kind, file_id in block.get('file_ids') or []]
+    )
+
+
+def _describe(item):
+    what = 'изображение' if item.kind == 'photo' else 'видео'
+    if item.url or item.source != 'bytes':
+        return f"{what} {item.url or item.value}"
+    return f"{what} ({len(item.value)} байт)"
+
+
+async def _fit(item):
+    """Видео, которое Telegram примет: перекодированное, если оно больше лимита или не mp4."""
     try:
-        with requests.get(url, timeout=120, stream=True) as r:
-            r.raise_for_status()
-            with open(out_path, 'wb') as f:
-                for chunk in r.iter_content(64 * 1024):
-                    if chunk:
-                        f.write(chunk)
-        success = True
-        return out_path
-    finally:
-        if not success and os.path.exists(out_path):
-            os.remove(out_path)
+        data = await fit_video(item.value)
+    except BaseException:
+        _discard(item)
+        raise
+    return item._replace(source=_local_source(data), value=data)
+
+
+def _is_remote_video(item):
+    return item.kind == 'video' and item.source == 'url'
+
+
+def _url_host_ok(url):
+    """Стоит ли отдавать видео с этого хоста по URL: пока не знаем — да, дальше по статистике."""
+    accepted, rejected = URL_HOSTS.get(metrics.site(url)) or (0, 0)
+    return rejected < 2 or accepted >= rejected * 3
+
+
+def _learn_url_host(url, accepted):
+    host = metrics.site(url)
+    stats = URL_HOSTS.get(host) or [0, 0]
+    stats[0 if accepted else 1] += 1
+    URL_HOSTS.set(host, stats)
+    metrics.URL_VIDEOS.inc('accepted' if accepted else 'rejected')
+
+
+async def _send_by_url(url):
+    if not SEND_VIDEO_BY_URL or not urlsplit(url).path.lower().endswith('.mp4') or not _url_host_ok(url):
+        return False
+    available, size = await probe_size(url)
+    return available and (size is None or size <= URL_VIDEO_SIZE_CAP)
+
+
+async def _can_stream(url):
+    """Можно ли отдать видео потоком как есть: mp4 известного размера в пределах лимита загрузки."""
+    if not SEND_VIDEO_STREAMING or not urlsplit(url).path.lower().endswith('.mp4'):
+        return False
+    available, size = await probe_size(url)
+    return available and size is not None and size <= UPLOAD_SIZE_CAP
+
+
+async def _prepare(item, use_cache=True, by_url=True, stream=True):
+    """Подготовить элемент к отправке: file_id из кэша или, для видео, скачанный и подогнанный файл.
+
+    Видео, которое Telegram, скорее всего, скачает сам, остаётся ссылкой (by_url=False — всегда качать);
+    подходящее для потоковой загрузки — источником 'stream' (stream=False — качать в файл).
+    """
+    if item.source in ('file', 'bytes') and item.kind == 'video':
+        return await _fit(item)
+    if item.source != 'url':
+        return item
+    if use_cache:
+        cached = FILE_CACHE.get(f'media:{item.url}')
+        if cached:
+            return item._replace(kind=cached[0], source='file_id', value=cached[1])
+    if item.kind == 'video':
+        if by_url and await _send_by_url(item.url):
+            return item
+        if stream and await _can_stream(item.url):
+            return item._replace(source='stream')
+        data = await download_to_spool(item.url, 'download', '.mp4', in_memory=True)
+        return await _fit(item._replace(source=_local_source(data), value=data))
+    return item
+
+
+def _discard(item):
+    if item.source == 'file':
+        SPOOL.release(item.value)
+
+
+def _upload(item):
+    """InputFile для медиа в памяти: имя файла подсказывает Telegram тип."""
+    return InputFile(item.value, filename='photo.jpg' if item.kind == 'photo' else 'video.mp4')
+
+
+async def _send_item(bot, chat_id, item):
+    if item.source == 'file' and TELEGRAM_LOCAL_MODE:
+        # Локальный сервер Bot API читает файл сам: передаём путь (PTB превратит его в file://).
+        kind = 'photo' if item.kind == 'photo' else 'video'
+        return await SENDER.call(bot, f'send_{kind}', chat_id, **{kind: item.value}, **SEND_TIMEOUTS)
+    if item.source == 'file':
+        kind = 'photo' if item.kind == 'photo' else 'video'
+        with open(item.value, 'rb') as f:
+            return await SENDER.call(bot, f'send_{kind}', chat_id, **{kind: f}, **SEND_TIMEOUTS)
+    if item.source == 'bytes':
+        kind = 'photo' if item.kind == 'photo' else 'video'
+        return await SENDER.call(bot, f'send_{kind}', chat_id, **{kind: _upload(item)}, **SEND_TIMEOUTS)
+    if item.source == 'stream':
+        return await SENDER.call(
+            StreamingUploader(bot), 'send_video', chat_id,
+            video=StreamUpload(item.value, 'video.mp4'), **SEND_TIMEOUTS,
+        )
+    return await SENDER.call(bot, f'send_{item.kind}', chat_id, **{item.kind: item.value}, **SEND_TIMEOUTS)
 
 
-async def retry_send_message(bot, chat_id, text, **kwargs):
-    max_retries = 3
-    retry_delay = 5
+async def _send_single(bot, chat_id, item, refs):
+    """Отправить элемент отдельным сообщением.
 
-    for attempt in range(max_retries):
+    Протухший file_id из кэша — повтор по исходному URL; видео, которое Telegram не скачал
+    по ссылке или не принял потоком (или прислал документом), — повтор со скачанным и подогнанным файлом.
+    """
+    remote = _is_remote_video(item)
+    streamed = item.source == 'stream'
+    try:
+        message = await _send_item(bot, chat_id, item)
+    except BadRequest as e:
+        if item.source == 'file_id' and item.url:
+            logger.warning("file_id из кэша отклонён, отправляем заново: %s", e)
+            FILE_CACHE.delete(f'media:{item.url}')
+        elif remote:
+            logger.info("Telegram не принял видео по ссылке, загружаем сами: %s", e)
+            _learn_url_host(item.url, False)
+        elif streamed:
+            logger.info("Telegram не принял видео потоком, загружаем файлом: %s", e)
+        else:
+            raise
+    except Exception as e:
+        # Таймаут после загрузки не повод слать файлом: Telegram мог уже опубликовать видео.
+        if not streamed or not not_delivered(e):
+            raise
+        logger.warning("Потоковая отправка видео не удалась, загружаем файлом: %s", e)
+    else:
+        if not (remote or streamed) or message.video or message.animation:
+            if remote:
+                _learn_url_host(item.url, True)
+            _remember(refs, item, message)
+            return
+        logger.info("Видео пришло не как видео, загружаем сами: %s", item.url)
+        if remote:
+            _learn_url_host(item.url, False)
         try:
-            return await bot.send_message(chat_id=chat_id, text=text, **kwargs)
-        except RetryAfter as e:
-            if attempt == max_retries - 1:
-                raise
-            await asyncio.sleep(e.retry_after)
-        except (TimedOut, NetworkError):
-            if attempt == max_retries - 1:
-                raise
-            await asyncio.sleep(retry_delay)
-            retry_delay *= 2
-
-
-async def _send_url(bot, chat_id, kind, url):
-    if kind == 'photo':
-        await bot.send_photo(chat_id=chat_id, photo=url, **SEND_TIMEOUTS)
-        return
-    path = await asyncio.to_thread(_stream_to_temp, url)
-    await _send_file(bot, chat_id, 'video', path)
+            await SENDER.call(bot, 'delete_message', chat_id, cost=0, message_id=message.message_id)
+        except Exception as e:
+            logger.warning("Не удалось удалить сообщение: %s", e)
+    kind = 'photo' if item.kind == 'photo' else 'video'
+    retry = await _prepare(
+        MediaItem(kind, 'url', item.url, item.url), use_cache=False, by_url=not (remote or streamed), stream=False,
+    )
+    try:
+        _remember(refs, retry, await _send_item(bot, chat_id, retry))
+    finally:
+        _discard(retry)
+
+
+def _input_media(item):
+    cls = InputMediaPhoto if item.kind == 'photo' else InputMediaVideo
+    if item.source == 'file' and TELEGRAM_LOCAL_MODE:
+        return cls(media=item.value)
+    if item.source == 'file':
+        with open(item.value, 'rb') as f:
+            return cls(media=f)  # InputFile читает содержимое сразу
+    if item.source == 'bytes':
+        return cls(media=_upload(item))
+    return cls(media=item.value)
+
+
+def _albums(items):
+    """Разбить элементы на альбомы до MEDIA_GROUP_LIMIT; анимации, документы и потоковые видео — поштучно."""
+    album = []
+    for item in items:
+        if item.kind not in ('photo', 'video') or item.source == 'stream':
+            if album:
+                yield album
+                album = []
+            yield [item]
+            continue
+        album.append(item)
+        if len(album) == MEDIA_GROUP_LIMIT:
+            yield album
+            album = []
+    if album:
+        yield album
+
+
+async def _prepare_all(items):
+    """Подготовить элементы параллельно. Результаты (или исключения) — в порядке элементов."""
+    tasks = [asyncio.ensure_future(_prepare(item)) for item in items]
+    if not tasks:
+        return []
+    try:
+        await asyncio.wait(tasks)
+    except asyncio.CancelledError:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for task in tasks:
+            if not task.cancelled() and task.exception() is None:
+                _discard(task.result())
+        raise
+    return [task.exception() or task.result() for task in tasks]
+
+
+def _discard_prepared(prepared):
+    for _, result in prepared:
+        if isinstance(result, MediaItem):
+            _discard(result)
+
+
+async def _produce(content, queue, skip):
+    if not hasattr(content, '__aiter__'):
+        content = iter_blocks(content)
+    try:
+        async with contextlib.aclosing(content):
+            async for block in content:
+                if skip:
+                    skip -= 1  # доставлен до рестарта
+                    for item in _block_items(block):
+                        _discard(item)  # парсер мог уже скачать медиа блока в спул
+                    continue
+                items = _block_items(block)
+                prepared = list(zip(items, await _prepare_all(items)))
+                try:
+                    await queue.put((block, prepared))
+                except BaseException:
+                    _discard_prepared(prepared)
+                    raise
+        await queue.put(None)
+    except Exception as e:
+        await queue.put(e)
+
+
+@contextlib.asynccontextmanager
+async def _pipeline(content, skip=0):
+    """Готовить блоки (парсинг, скачивание медиа) параллельно с отправкой предыдущих.
+
+    Вперёд готовится не больше PIPELINE_LOOKAHEAD блоков — диск и память ограничены.
+    Первые skip блоков пропускаются: медиа по ссылкам не качается, уже скачанное парсером
+    (файлы спула) сразу освобождается.
+    Отдаёт асинхронный итератор пар (block, prepared); при выходе неотправленные файлы удаляются.
+    """
+    queue = asyncio.Queue(PIPELINE_LOOKAHEAD)
+    producer = asyncio.create_task(_produce(content, queue, skip))
+
+    async def consume():
+        while True:
+            entry = await queue.get()
+            if entry is None:
+                return
+            if isinstance(entry, Exception):
+                raise entry
+            yield entry
+
+    try:
+        yield consume()
+    finally:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+        while not queue.empty():
+            entry = queue.get_nowait()
+            if isinstance(entry, tuple):
+                _discard_prepared(entry[1])
+
 
+async def _send_media(bot, chat_id, prepared, refs):
+    """Отправить подготовленные медиа блока альбомами. Returns True if every item was sent."""
+    ok = True
+    ready = []
+    for item, result in prepared:
+        if isinstance(result, Exception):
+            await _report_send_error(bot, chat_id, f"Не удалось отправить {_describe(item)}\n{result}")
+            ok = False
+        else:
+            ready.append(result)
 
-async def _send_file(bot, chat_id, kind, path):
     try:
-        with open(path, 'rb') as f:
-            if kind == 'photo':
-                await bot.send_photo(chat_id=chat_id, photo=f, **SEND_TIMEOUTS)
-            else:
-                await bot.send_video(chat_id=chat_id, video=f, **SEND_TIMEOUTS)
+        for album in _albums(ready):
+            if len(album) > 1:
+                try:
+                    messages = await SENDER.call(
+                        bot, 'send_media_group', chat_id, cost=len(album),
+                        media=[_input_media(item) for item in album], **SEND_TIMEOUTS,
+                    )
+                    for item, message in zip(album, messages):
+                        if _is_remote_video(item):
+                            _learn_url_host(item.url, True)
+                        _remember(refs, item, message)
+                    continue
+                except BadRequest as e:
+                    # Telegram отверг какой-то элемент — поштучно уйдут остальные.
+                    logger.warning("Альбом из %s не отправлен, отправляем поштучно: %s", len(album), e)
+                except Exception as e:
+                    # Таймаут или обрыв: альбом мог уже опубликоваться, повтор поштучно его задублирует.
+                    await _report_send_error(bot, chat_id, f"Не удалось отправить альбом из {len(album)} медиа\n{e}")
+                    ok = False
+                    continue
+            for item in album:
+                try:
+                    await _send_single(bot, chat_id, item, refs)
+                except Exception as e:
+                    await _report_send_error(bot, chat_id, f"Не удалось отправить {_describe(item)}\n{e}")
+                    ok = False
     finally:
-        if os.path.exists(path):
-            os.remove(path)
+        for item in ready:
+            _discard(item)
+    return ok
 
 
 async def _safe_send(bot, chat_id, text, **kwargs):
@@ -122,14 +498,10 @@ async def _safe_send(bot, chat_id, text, **kwargs):
 
 async def _report_send_error(bot, chat_id, message):
     logger.error(message)
-    await _safe_send(bot, chat_id, message)
-
+    await SENDER.report(bot, chat_id, message)
 
-async def process_content(bot, update, title, content):
-    """Returns True if title and every media item was sent successfully."""
-    chat_id = update.message.chat.id
-    ok = True
 
+async def _send_title(bot, chat_id, title):
     try:
         await retry_send_message(
             bot, chat_id, title,
@@ -141,76 +513,202 @@ async def process_content(bot, update, title, content):
             await retry_send_message(bot, chat_id, title, disable_web_page_preview=True)
         except Exception as plain_err:
             await _report_send_error(bot, chat_id, f"Не удалось отправить заголовок: {plain_err}")
-            ok = False
+            return False
+    return True
 
-    try:
-        for block in content:
-            if block.get('text'):
-                for chunk in _chunk_text(block['text']):
-                    try:
-                        await retry_send_message(bot, chat_id, chunk, disable_web_page_preview=True)
-                    except Exception as e:
-                        await _report_send_error(bot, chat_id, f"Не удалось отправить текст: {e}")
-                        ok = False
-
-            for url in block.get('images') or []:
-                try:
-                    await _send_url(bot, chat_id, 'photo', url)
-                except Exception as e:
-                    await _report_send_error(bot, chat_id, f"Не удалось отправить изображение {url}\n{e}")
-                    ok = False
-            for url in block.get('videos') or []:
-                try:
-                    await _send_url(bot, chat_id, 'video', url)
-                except Exception as e:
-                    await _report_send_error(bot, chat_id, f"Не удалось отправить видео {url}\n{e}")
-                    ok = False
-            for path in block.get('image_files') or []:
-                try:
-                    await _send_file(bot, chat_id, 'photo', path)
-                except Exception as e:
-                    await _report_send_error(bot, chat_id, f"Не удалось отправить изображение {path}\n{e}")
-                    ok = False
-            for path in block.get('video_files') or []:
-                try:
-                    await _send_file(bot, chat_id, 'video', path)
-                except Exception as e:
-                    await _report_send_error(bot, chat_id, f"Не удалось отправить видео файл {path}\n{e}")
+
+async def process_content(bot, update, title, content, sent=None, progress=None):
+    """Returns True if title and every media item was sent successfully.
+
+    `content` is an async iterator of blocks (or a plain list); blocks are prepared ahead
+    while earlier ones are being sent. If `sent` is a list, it receives the blocks as they
+    were delivered, with media replaced by `file_ids` entries — ready to be replayed from FILE_CACHE.
+    `progress` (JobProgress) counts delivered parts — the title, then each block; parts
+    already delivered before a restart are skipped.
+    """
+    chat_id = update.message.chat.id
+    done = progress.done if progress else 0
+    async with _pipeline(content, skip=max(done - 1, 0)) as blocks:
+        ok = True
+        if not done:
+            ok = await _send_title(bot, chat_id, title)
+            if progress:
+                progress.sent()
+        try:
+            async for block, prepared in blocks:
+                refs = []
+                if block.get('text'):
+                    for chunk in _chunk_text(block['text']):
+                        try:
+                            await retry_send_message(bot, chat_id, chunk, disable_web_page_preview=True)
+                        except Exception as e:
+                            await _report_send_error(bot, chat_id, f"Не удалось отправить текст: {e}")
+                            ok = False
+
+                if prepared and not await _send_media(bot, chat_id, prepared, refs):
                     ok = False
-    except Exception as e:
-        await _report_send_error(bot, chat_id, f"Произошла ошибка при обработке контента: {e}")
-        ok = False
+                if sent is not None:
+                    sent.append({'text': block.get('text'), 'file_ids': refs})
+                if progress:
+                    progress.sent()
+        except Exception as e:
+            await _report_send_error(bot, chat_id, f"Произошла ошибка при обработке контента: {e}")
+            ok = False
 
     return ok
 
 
-async def _handle_match(bot, update, spec):
+def _land(cache_key, flight):
+    """Обработка поста закончена: разбудить тех, кто ждёт его в других чатах."""
+    if flight is not None and not flight.landed.done():
+        flight.landed.set_result(None)
+        if _FLIGHTS.get(cache_key) is flight:
+            del _FLIGHTS[cache_key]
+
+
+async def _parse_link(update, spec, link, turn):
+    """Заголовок, блоки, ключ кэша поста, флаг «из кэша» и Flight обработки (её завершает _land).
+
+    Пост из кэша file_id не парсится; если он уже отправляется в другой чат — ждём окончания и
+    берём из кэша. Недоступный пост сразу даёт ContentUnavailable из UNAVAILABLE. turn — событие
+    «очередь дошла до этой ссылки»: пока оно не наступило, другие чаты эту обработку не ждут.
+    """
+    cache_key = f'post:{canonical_url(link)}'
+    while True:
+        cached = FILE_CACHE.get(cache_key)
+        if cached:
+            logger.info("%s - отправка из кэша file_id (%s)", spec.label, FILE_CACHE.stats())
+            title = replace_title_user(cached['title'], update.message.from_user)
+            return title, cached['blocks'], cache_key, True, None
+        reason = UNAVAILABLE.get(cache_key)
+        if reason:
+            raise ContentUnavailable(reason)
+        flight = _FLIGHTS.get(cache_key)
+        if flight is None:
+            break
+        if not flight.turn.is_set():
+            logger.info("%s - пост обрабатывается для другого чата, но ждёт очереди — парсим сами", spec.label)
+            break
+        logger.info("%s - пост уже отправляется в другой чат, ждём", spec.label)
+        try:
+            await asyncio.wait_for(asyncio.shield(flight.landed), FLIGHT_WAIT)
+        except asyncio.TimeoutError:
+            logger.info("%s - не дождались другой обработки, парсим сами", spec.label)
+            break
+    flight = None
+    if cache_key not in _FLIGHTS:
+        flight = _FLIGHTS[cache_key] = Flight(asyncio.get_running_loop().create_future(), turn)
+    logger.info("Парсинг %s - начало (кэш file_id: %s)", spec.label, FILE_CACHE.stats())
+    try:
+        with metrics.PARSE_SECONDS.time(spec.label):
+            title, content = await spec.func(link, update.message.from_user)
+    except BaseException as e:
+        if isinstance(e, ContentUnavailable):
+            UNAVAILABLE.set(cache_key, str(e))
+        _land(cache_key, flight)
+        raise
+    logger.info("Парсинг %s - завершен, отправка по мере загрузки", spec.label)
+    return title, content, cache_key, False, flight
+
+
+async def _deliver(bot, update, spec, parse, progress):
+    """Отправить пост, когда до него дошла очередь. Returns True if sending was attempted."""
     chat_id = update.message.chat.id
-    logger.info("Парсинг %s - начало", spec.label)
     try:
-        title, content = await spec.func(update.message.text, update.message.from_user)
+        title, content, cache_key, from_cache, flight = await parse
     except Exception as e:
         if spec.auth_exc and isinstance(e, spec.auth_exc):
             logger.info("%s - контент требует авторизации", spec.label)
             await _safe_send(bot, chat_id, spec.auth_msg, disable_web_page_preview=True)
-            return
-        logger.error("ОШИБКА обработки %s: %s", spec.label, e, exc_info=True)
+            return False
+        if isinstance(e, ContentUnavailable):
+            logger.info("%s - контент недоступен: %s", spec.label, e)
+        else:
+            logger.error("ОШИБКА обработки %s: %s", spec.label, e, exc_info=True)
         await _safe_send(
             bot, chat_id, f'Не удалось обработать ссылку\n{e}',
             disable_web_page_preview=True,
         )
-        return
+        return False
 
-    logger.info("Парсинг %s - завершен, блоков: %s", spec.label, len(content))
-    ok = await process_content(bot, update, title, content)
     try:
-        await update.message.delete()
-    except Exception as e:
-        logger.warning("Не удалось удалить исходное сообщение: %s", e)
+        progress.state(DOWNLOAD)
+        # Пост, дочитанный после рестарта, в кэш не попадает: начало его блоков отправлено раньше.
+        sent = None if from_cache or progress.done else []
+        ok = await process_content(bot, update, title, content, sent, progress)
+        if from_cache and not ok:
+            FILE_CACHE.delete(cache_key)  # file_id мог протухнуть — в следующий раз скачаем заново
+        elif sent is not None and ok:
+            FILE_CACHE.set(cache_key, {'title': title, 'blocks': sent})
+    finally:
+        _land(cache_key, flight)
     if ok:
         logger.info("%s - успешно обработано", spec.label)
     else:
         logger.info("%s - обработано с ошибками", spec.label)
+    return True
+
+
+async def _handle_message(bot, update, links, job):
+    """Разобрать все ссылки сообщения параллельно; посты отправляются в порядке ссылок.
+
+    Задача job продолжается с места остановки: ссылки до job.link_index уже обработаны.
+    """
+    start = job.link_index
+    turns = [asyncio.Event() for _ in links[start:]]
+    parses = [
+        asyncio.ensure_future(_parse_link(update, spec, link, turn))
+        for (spec, link), turn in zip(links[start:], turns)
+    ]
+    delivered = job.delivered
+    try:
+        for i, ((spec, _), parse, turn) in enumerate(zip(links[start:], parses, turns), start):
+            progress = JobProgress(JOBS, job.id, i, job.progress if i == start else 0)
+            progress.state(PARSE)
+            turn.set()  # предыдущие ссылки отправлены — эту обработку могут ждать другие чаты
+            delivered = await _deliver(bot, update, spec, parse, progress) or delivered
+    finally:
+        for parse in parses:
+            if not parse.done():
+                parse.cancel()
+            elif not parse.cancelled() and parse.exception() is None:
+                # Разобранный, но не отправленный пост (отправка прервалась) не должен держать ждущих.
+                _, _, cache_key, _, flight = parse.result()
+                _land(cache_key, flight)
+    if delivered:
+        try:
+            await SENDER.call(bot, 'delete_message', update.message.chat.id, cost=0,
+                              message_id=update.message.message_id)
+        except Exception as e:
+            logger.warning("Не удалось удалить исходное сообщение: %s", e)
+    JOBS.finish(job.id)
+
+
+async def _run_job(bot, update, links, job):
+    try:
+        await _handle_message(bot, update, links, job)
+    except Exception:
+        # Ошибка, а не рестарт (отмена при остановке сюда не попадает): повтор её не исправит.
+        JOBS.finish(job.id, FAILED)
+        raise
+
+
+async def _resume_jobs(bot):
+    """Поставить в очередь задачи, не завершённые до рестарта."""
+    specs = {spec.label: spec for spec in PARSERS if spec.enabled}
+    for job in JOBS.pending():
+        if any(label not in specs for label, _ in job.links):
+            logger.warning("Задача %s: парсер больше не включён, пропускаем", job.id)
+            JOBS.finish(job.id, FAILED)
+            continue
+        update = Update.de_json(job.update, bot)
+        links = [(specs[label], link) for label, link in job.links]
+        logger.info("Возобновление задачи %s в чате %s: ссылка %s из %s, доставлено частей: %s",
+                    job.id, job.chat_id, job.link_index + 1, len(links), job.progress)
+        sources = {spec.label for spec, _ in links[job.link_index:]}
+        await SCHEDULER.submit(
+            job.chat_id, sources, lambda update=update, links=links, job=job: _run_job(bot, update, links, job),
+        )
 
 
 async def check_links(update: Update, context) -> None:
@@ -226,10 +724,11 @@ async def check_links(update: Update, context) -> None:
         user.full_name, user.id, chat_id, message_text[:50],
     )
 
-    for spec in PARSERS:
-        if spec.enabled and re.search(spec.regex, message_text, re.IGNORECASE):
-            await _handle_match(context.bot, update, spec)
-            return
+    links = DISPATCHER.dispatch(message_text)
+    if links:
+        sources = {spec.label for spec, _ in links}
+        job = JOBS.add(chat_id, update.to_dict(), [(spec.label, link) for spec, link in links])
+        await SCHEDULER.submit(chat_id, sources, lambda: _run_job(context.bot, update, links, job))
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -243,19 +742,118 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     )
 
 
-async def _on_shutdown(application):
-    await reddit.close()
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Linux считает в КБ
+
 
+def _report_startup():
+    ready = time.perf_counter() - _STARTED
+    imported = _IMPORTED - _STARTED
+    metrics.STARTUP_SECONDS.callback = lambda: {('import',): imported, ('ready',): ready}
+    rss = _peak_rss_mb()
+    logger.info(
+        "Старт: импорт %.0f мс, до приёма обновлений %.0f мс, парсеров загружено %s из %s%s",
+        imported * 1000, ready * 1000, sum(p.loaded for p in PARSERS), sum(p.enabled for p in PARSERS),
+        f", пик памяти {rss:.0f} МБ" if rss else "",
+    )
+
+
+async def _on_startup(application):
+    _report_startup()
+    application.bot_data['metrics_server'] = await metrics.start_server()
+    if PARSERS_PRELOAD:
+        application.bot_data['parsers_preload'] = asyncio.create_task(sources.preload())
+    application.bot_data['spool_sweeper'] = asyncio.create_task(SPOOL.run_sweeper())
+    application.bot_data['job_resume'] = asyncio.create_task(_resume_jobs(application.bot))
+
+
+async def _on_shutdown(application):
+    server = application.bot_data.get('metrics_server')
+    if server:
+        server.close()
+        await server.wait_closed()
+    resume = application.bot_data.get('job_resume')
+    if resume:
+        resume.cancel()
+    preload = application.bot_data.get('parsers_preload')
+    if preload:
+        preload.cancel()
+    await SCHEDULER.close()
+    await SENDER.close()
+    sweeper = application.bot_data.get('spool_sweeper')
+    if sweeper:
+        sweeper.cancel()
+    reddit = sources.loaded('reddit')
+    if reddit:
+        await reddit.close()
+    instagram = sources.loaded('instagram')
+    if instagram:
+        await instagram.SESSIONS.close()
+        instagram.MEDIA_CACHE.close()
+    await close_http_client()
+    FILE_CACHE.close()
+    URL_HOSTS.close()
+    UNAVAILABLE.close()
+    JOBS.close()
+
+
+async def _run_webhook(application):
+    """Жизненный цикл как у run_polling, но обновления приходят в WebhookServer."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):  # Windows: остановка через KeyboardInterrupt
+            loop.add_signal_handler(sig, stop.set)
+    await application.initialize()
+    server = None
+    try:
+        await _on_startup(application)
+        # Сначала занимаем порт: если он занят, приложение ещё не запущено и честно падает с ошибкой bind.
+        server = await WebhookServer(application, urlsplit(WEBHOOK_URL).path or '/', WEBHOOK_SECRET).start(
+            WEBHOOK_LISTEN, WEBHOOK_PORT,
+        )
+        await application.start()
+        await application.bot.set_webhook(
+            WEBHOOK_URL, allowed_updates=ALLOWED_UPDATES, secret_token=WEBHOOK_SECRET,
+        )
+        logger.info("Webhook зарегистрирован: %s", WEBHOOK_URL)
+        await stop.wait()
+    finally:
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        await _on_shutdown(application)
 
 if __name__ == '__main__':
     request = HTTPXRequest(read_timeout=60, write_timeout=60, connect_timeout=60, pool_timeout=60)
+    builder = ApplicationBuilder().token(TOKEN).request(request)
+    if TELEGRAM_API_URL:
+        logger.info("Bot API: %s%s", TELEGRAM_API_URL, " (локальный режим)" if TELEGRAM_LOCAL_MODE else "")
+        builder = (
+            builder
+            .base_url(f'{TELEGRAM_API_URL}/bot')
+            .base_file_url(f'{TELEGRAM_API_URL}/file/bot')
+            .local_mode(TELEGRAM_LOCAL_MODE)
+        )
+    if WEBHOOK_URL:
+        builder = builder.updater(None)
     app = (
-        ApplicationBuilder()
-        .token(TOKEN)
-        .request(request)
+        builder
+        .concurrent_updates(True)
+        .post_init(_on_startup)
         .post_shutdown(_on_shutdown)
         .build()
     )
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, check_links))
     app.add_error_handler(error_handler)
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        asyncio.run(_run_webhook(app))
+    else:
+        app.run_polling(allowed_updates=ALLOWED_UPDATES)
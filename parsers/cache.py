@@ -0,0 +1,114 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from parsers import metrics
+from parsers.common import logger
+
+
+# Общая база кэшей бота (file_id, хосты видео по URL, метаданные Instagram) — по таблице на кэш.
+FILE_CACHE_PATH = os.getenv(
+    'FILE_CACHE_PATH',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'file_cache.sqlite3'),
+)
+
+_caches = []
+
+
+def _lookups():
+    counts = {}
+    for cache in _caches:
+        counts[(cache.table, 'hit')] = cache.hits
+        counts[(cache.table, 'miss')] = cache.misses
+    return counts
+
+
+metrics.CACHE_LOOKUPS.callback = _lookups
+
+
+class PersistentCache:
+    """Key-value кэш в SQLite: TTL на запись, LRU-вытеснение и потолок по числу записей.
+
+    Значения хранятся как JSON. Пустой path выключает кэш: get() всегда промах, set() — no-op.
+    """
+
+    def __init__(self, path, table, ttl, max_entries):
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        _caches.append(self)
+        if not path:
+            return
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, used REAL NOT NULL)"
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_used ON {table} (used)")
+
+    @property
+    def enabled(self):
+        return self._conn is not None
+
+    def stats(self):
+        return f"hits={self.hits}, misses={self.misses}"
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, expires FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or row[1] <= now:
+                if row is not None:
+                    self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                self.misses += 1
+                hit = False
+            else:
+                self._conn.execute(f"UPDATE {self.table} SET used = ? WHERE key = ?", (now, key))
+                self.hits += 1
+                hit = True
+        logger.debug("Кэш %s: %s %s (%s)", self.table, "попадание" if hit else "промах", key, self.stats())
+        return json.loads(row[0]) if hit else None
+
+    def set(self, key, value, ttl=None):
+        if not self.enabled:
+            return
+        now = time.time()
+        expires = now + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires, used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expires, now),
+            )
+            self._conn.execute(f"DELETE FROM {self.table} WHERE expires <= ?", (now,))
+            # LRU: всё, что не влезло в max_entries самых свежих по использованию.
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN "
+                f"(SELECT key FROM {self.table} ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def delete(self, key):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def close(self):
+        if self.enabled:
+            logger.info("Кэш %s: %s", self.table, self.stats())
+            with self._lock:
+                self._conn.close()
+            self._conn = None
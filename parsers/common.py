@@ -1,13 +1,58 @@
+import asyncio
+import contextlib
+import importlib.util
 import logging
 import os
 import random
+import re
 import string
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from urllib.parse import unquote, urlsplit
+
+import httpx
+
+from parsers import metrics
 
 
 logger = logging.getLogger('trash_meme_bot')
 
 TEMP_DIR = os.getenv('TEMP_DIR')
 
+# Свой сервер Bot API (telegram-bot-api), например http://127.0.0.1:8081. В режиме --local он
+# читает загружаемые файлы прямо с диска по пути и принимает их до 2000 МБ.
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '').rstrip('/')
+TELEGRAM_LOCAL_MODE = bool(int(os.getenv('TELEGRAM_LOCAL_MODE') or ('1' if TELEGRAM_API_URL else '0')))
+# Лимит Bot API на загрузку файла ботом.
+UPLOAD_SIZE_CAP = int(os.getenv('TELEGRAM_UPLOAD_LIMIT_MB') or (2000 if TELEGRAM_LOCAL_MODE else 50)) * 1024 * 1024
+# Картинку по URL Telegram скачивает сам, но только до 5 МБ.
+URL_PHOTO_SIZE_CAP = 5 * 1024 * 1024
+
+# Бюджет при выборе варианта медиа: байты для видео и длинная сторона в пикселях.
+MEDIA_MAX_BYTES = int(os.getenv('MEDIA_MAX_MB') or UPLOAD_SIZE_CAP // 2 ** 20) * 1024 * 1024
+MEDIA_MAX_RESOLUTION = int(os.getenv('MEDIA_MAX_RESOLUTION', '1920'))
+_PROBE_CACHE_SIZE = 4096
+
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '64'))
+HTTP_MAX_PER_HOST = int(os.getenv('HTTP_MAX_PER_HOST', '6'))
+HTTP_CHUNK_SIZE = 64 * 1024
+# HTTP/2 включается, только если установлен h2 (httpx[http2]); иначе остаёмся на HTTP/1.1 keep-alive.
+_HTTP2 = importlib.util.find_spec('h2') is not None
+
+_http_client = None
+_host_slots = {}
+
+SPOOL_MAX_BYTES = int(os.getenv('SPOOL_MAX_MB', '2048')) * 1024 * 1024  # 0 — без лимита
+SPOOL_WAIT_TIMEOUT = int(os.getenv('SPOOL_WAIT_TIMEOUT', '120'))
+SPOOL_MEMORY_MAX_BYTES = int(os.getenv('SPOOL_IN_MEMORY_KB', '1024')) * 1024
+SPOOL_SWEEP_INTERVAL = int(os.getenv('SPOOL_SWEEP_INTERVAL', '600'))
+SPOOL_ORPHAN_AGE = int(os.getenv('SPOOL_ORPHAN_AGE', '21600'))
+SPOOL_PREFIX = 'tmb_'
+# Имена временных файлов до появления спула — подчищаются при старте.
+_LEGACY_TEMP_PREFIXES = ('download_', 'insta_', 'temp_video_', 'temp_audio_', 'compiled_video_')
+
 
 def generate_random_string(length=5):
     letters = string.ascii_letters
@@ -27,10 +72,55 @@ def escape_markdown_link_url(url):
     return url.replace('\\', '\\\\').replace(')', '\\)')
 
 
+def _title_user(user):
+    return escape_markdown(user.full_name) if user.full_name else 'Unknown User'
+
+
 def generate_title(user, url, title=None):
     title = f'{escape_markdown(title)}\n' if title else ''
-    user_name = escape_markdown(user.full_name) if user.full_name else 'Unknown User'
-    return f'{user_name}\n{title}[Посмотреть оригинал]({escape_markdown_link_url(url)})'
+    return f'{_title_user(user)}\n{title}[Посмотреть оригинал]({escape_markdown_link_url(url)})'
+
+
+def replace_title_user(title, user):
+    """Подставить в готовый заголовок (из generate_title) имя другого отправителя."""
+    _, _, rest = title.partition('\n')
+    return f'{_title_user(user)}\n{rest}'
+
+
+class ContentUnavailable(ValueError):
+    """Пост удалён, скрыт или приватный: повтор ничего не даст, ответ кэшируется ненадолго."""
+
+
+_HOST_PREFIXES = ('www.', 'mobile.', 'm.', 'old.', 'new.')
+_POST_ID_PATTERNS = (
+    (re.compile(r'(?:twitter\.com|x\.com)/\S*?status/(\d+)', re.I), 'https://x.com/i/status/{}'),
+    (re.compile(r'instagram\.com/(?:reels?|p)/([A-Za-z0-9_-]+)', re.I), 'https://www.instagram.com/p/{}/'),
+    (re.compile(r'reddit\.com/(?:r/[^/\s]+/)?comments/([a-z0-9]+)', re.I), 'https://www.reddit.com/comments/{}/'),
+)
+
+
+def canonical_url(url):
+    """Привести ссылку на пост к одному виду: одинаковые посты — одинаковая строка.
+
+    Для источников с id поста в URL (X, Instagram, Reddit) ключ строится по id,
+    для остальных — хост без www./m. и путь без query/fragment.
+    """
+    if '%2F' in url.upper():
+        url = unquote(url)
+        url = url[url.find('http'):] if 'http' in url else url
+    for pattern, template in _POST_ID_PATTERNS:
+        m = pattern.search(url)
+        if m:
+            return template.format(m.group(1))
+    if '://' not in url:
+        url = 'https://' + url
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+    for prefix in _HOST_PREFIXES:
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    return f'https://{host}{parts.path.rstrip("/")}'
 
 
 def build_http_headers():
@@ -42,3 +132,303 @@ def build_http_headers():
     if accept_language:
         headers['Accept-Language'] = accept_language
     return headers
+
+
+def http_client():
+    """Общий httpx.AsyncClient: keep-alive пул, HTTP/2 и заголовки build_http_headers() по умолчанию.
+
+    Куки от ответов не сохраняются (политика без разрешённых доменов): клиент общий для всех
+    источников, а сессионные куки (Instagram) передаются явно в заголовках запроса.
+    """
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            headers=build_http_headers(),
+            cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+            follow_redirects=True,
+            http2=_HTTP2,
+            timeout=30,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+                keepalive_expiry=60,
+            ),
+        )
+    return _http_client
+
+
+@contextlib.asynccontextmanager
+async def _host_slot(url):
+    """Ограничить число одновременных запросов к одному хосту (httpx умеет только общий лимит)."""
+    host = urlsplit(str(url)).hostname or ''
+    slot = _host_slots.get(host)
+    if slot is None:
+        slot = _host_slots[host] = asyncio.Semaphore(HTTP_MAX_PER_HOST)
+    async with slot:
+        yield
+
+
+async def http_get(url, **kwargs):
+    async with _host_slot(url):
+        return await http_client().get(url, **kwargs)
+
+
+# Вариант одного медиа. size — оценка в байтах, если источник её даёт (битрейт × длительность).
+Variant = namedtuple('Variant', 'url width height size', defaults=(None, None, None))
+
+_probes = OrderedDict()
+
+
+async def probe_size(url, headers=None):
+    """(доступен ли, размер в байтах или None) по HEAD-запросу, без тела. Результаты кэшируются."""
+    cached = _probes.get(url)
+    if cached is not None:
+        _probes.move_to_end(url)
+        return cached
+    try:
+        async with _host_slot(url):
+            r = await http_client().head(url, headers=headers, timeout=10)
+    except httpx.HTTPError as e:
+        logger.debug("HEAD %s не удался: %s", url, e)
+        return True, None  # не знаем — не отбрасываем вариант, но и не кэшируем
+    if r.status_code in (403, 404, 410):
+        result = False, None
+    else:
+        length = r.headers.get('content-length') if r.is_success else None
+        result = True, int(length) if length and length.isdigit() else None
+    _probes[url] = result
+    if len(_probes) > _PROBE_CACHE_SIZE:
+        _probes.popitem(last=False)
+    return result
+
+
+async def pick_variant(variants, max_bytes=MEDIA_MAX_BYTES, max_resolution=MEDIA_MAX_RESOLUTION,
+                       headers=None, probe=True):
+    """URL лучшего варианта, который укладывается в бюджет по разрешению и размеру.
+
+    variants — Variant от лучшего к худшему. Размер узнаётся HEAD-запросом (probe=False — только
+    разрешение), варианты проверяются по очереди до первого подходящего. Если в бюджет не влезает
+    ничего, берётся самый лёгкий.
+    """
+    fitting = [v for v in variants if not v.width or not v.height or max(v.width, v.height) <= max_resolution]
+    fitting = fitting or variants[-1:]
+    if not probe:
+        return fitting[0].url
+    for variant in fitting:
+        available, size = await probe_size(variant.url, headers)
+        if not available:
+            continue
+        size = size or variant.size
+        if size is None or size <= max_bytes:
+            return variant.url
+        logger.debug("Вариант %s (%s байт) больше бюджета %s", variant.url, size, max_bytes)
+    return fitting[-1].url
+
+
+async def resolve_redirects(url, done=None, max_hops=5):
+    """Пройти по цепочке редиректов, не читая тела ответов. Вернуть конечный URL.
+
+    done(url) -> True останавливает обход раньше, когда нужное уже видно из адреса.
+    """
+    for _ in range(max_hops):
+        if done and done(url):
+            break
+        async with _host_slot(url):
+            async with http_client().stream('GET', url, follow_redirects=False, timeout=30) as r:
+                if not r.is_redirect:
+                    r.raise_for_status()
+                    break
+                url = str(r.url.join(r.headers['location']))
+    return url
+
+
+class Spool:
+    """Временные файлы загрузок в одном каталоге с общим лимитом места.
+
+    Файл спула учитывается от allocate() до release(): загрузка в него ждёт, пока занятое
+    место не уложится в max_bytes (но не дольше wait_timeout — потом качает сверх лимита,
+    чтобы медиа одного альбома не ждали друг друга вечно). Файлы с префиксом спула, которые
+    никто не держит (остались от упавшего процесса), удаляет sweep().
+    """
+
+    def __init__(self, directory, max_bytes, wait_timeout):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.wait_timeout = wait_timeout
+        self._sizes = {}
+        self._used = 0
+        self._freed = asyncio.Event()
+
+    def used(self):
+        return self._used
+
+    def allocate(self, prefix, ext):
+        """Новый уникальный путь в спуле; файл по нему создаёт вызывающий код."""
+        path = os.path.join(self.directory, f'{SPOOL_PREFIX}{prefix}_{uuid.uuid4().hex}{ext}')
+        self._sizes[path] = 0
+        return path
+
+    def _grow(self, path, total):
+        held = self._sizes.get(path)
+        if held is not None and total > held:
+            self._sizes[path] = total
+            self._used += total - held
+
+    def _fits(self, path, total):
+        held = self._sizes.get(path)
+        if held is None or total <= held:
+            return True
+        others = self._used - held
+        return not self.max_bytes or others == 0 or others + total <= self.max_bytes
+
+    async def reserve(self, path, total):
+        """Учесть под path не меньше total байт, дождавшись места. Чужие пути не учитываются."""
+        if not self._fits(path, total):
+            logger.info("Спул заполнен (%s из %s МБ), загрузка ждёт места",
+                        self._used // 2 ** 20, self.max_bytes // 2 ** 20)
+            deadline = time.monotonic() + self.wait_timeout
+            while not self._fits(path, total):
+                freed = self._freed
+                try:
+                    await asyncio.wait_for(freed.wait(), max(0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    logger.warning("Места в спуле нет %s с, качаем сверх лимита", self.wait_timeout)
+                    break
+        self._grow(path, total)
+
+    def account(self, path):
+        """Учесть файл, записанный в обход reserve() (например, ffmpeg), по его размеру на диске."""
+        held = self._sizes.get(path)
+        if held is None or not os.path.exists(path):
+            return
+        size = os.path.getsize(path)
+        self._sizes[path] = size
+        self._used += size - held
+        if size < held:
+            self._notify()
+
+    def _notify(self):
+        self._freed.set()
+        self._freed = asyncio.Event()
+
+    def release(self, path):
+        """Удалить файл и вернуть его место в лимит."""
+        if os.path.exists(path):
+            os.remove(path)
+        size = self._sizes.pop(path, None)
+        if size:
+            self._used -= size
+            self._notify()
+
+    def sweep(self, max_age=0, prefixes=(SPOOL_PREFIX,)):
+        """Удалить файлы с prefixes старше max_age секунд, которые не держит этот процесс."""
+        if not self.directory or not os.path.isdir(self.directory):
+            return 0
+        removed = 0
+        now = time.time()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if (not entry.name.startswith(prefixes) or entry.path in self._sizes
+                        or not entry.is_file(follow_symlinks=False)):
+                    continue
+                try:
+                    if now - entry.stat().st_mtime >= max_age:
+                        os.remove(entry.path)
+                        removed += 1
+                except OSError as e:
+                    logger.warning("Не удалось удалить %s: %s", entry.path, e)
+        if removed:
+            logger.info("Из спула удалено брошенных файлов: %s", removed)
+        return removed
+
+    async def run_sweeper(self, interval=SPOOL_SWEEP_INTERVAL, max_age=SPOOL_ORPHAN_AGE):
+        """Фоновая задача: при старте удалить всё брошенное, дальше — периодически старое."""
+        self.sweep(prefixes=(SPOOL_PREFIX, *_LEGACY_TEMP_PREFIXES))
+        while True:
+            await asyncio.sleep(interval)
+            self.sweep(max_age)
+
+
+SPOOL = Spool(TEMP_DIR, SPOOL_MAX_BYTES, SPOOL_WAIT_TIMEOUT)
+metrics.SPOOL_BYTES.callback = SPOOL.used
+
+
+async def _fetch(url, path, headers, timeout, memory_max=0):
+    """Скачать url в path или, если размер известен заранее и не больше memory_max, в bytes."""
+    async with _host_slot(url):
+        start = time.perf_counter()
+        async with http_client().stream('GET', url, headers=headers, timeout=timeout) as r:
+            r.raise_for_status()
+            length = int(r.headers.get('content-length') or 0)
+            if 0 < length <= memory_max:
+                result = await r.aread()
+                size = len(result)
+            else:
+                await SPOOL.reserve(path, length)
+                size = 0
+                with open(path, 'wb') as f:
+                    async for chunk in r.aiter_bytes(HTTP_CHUNK_SIZE):
+                        size += len(chunk)
+                        await SPOOL.reserve(path, size)
+                        f.write(chunk)
+                SPOOL.account(path)
+                result = path
+    metrics.DOWNLOAD_SECONDS.observe(time.perf_counter() - start, metrics.site(url))
+    metrics.DOWNLOAD_BYTES.observe(size, metrics.site(url))
+    return result
+
+
+async def download_to_file(url, path, headers=None, timeout=120):
+    """Скачать url в path по частям; недокачанный файл удаляется. Путь из SPOOL идёт в его лимит."""
+    try:
+        return await _fetch(url, path, headers, timeout)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+
+async def download_to_spool(url, prefix, ext, headers=None, timeout=120, in_memory=False):
+    """Скачать url в новый файл спула и вернуть путь — его освобождает SPOOL.release().
+
+    С in_memory небольшой ответ (до SPOOL_MEMORY_MAX_BYTES по Content-Length) возвращается
+    как bytes и на диск не попадает.
+    """
+    path = SPOOL.allocate(prefix, ext)
+    try:
+        result = await _fetch(url, path, headers, timeout, SPOOL_MEMORY_MAX_BYTES if in_memory else 0)
+    except BaseException:
+        SPOOL.release(path)
+        raise
+    if result is not path:
+        SPOOL.release(path)
+    return result
+
+
+async def iter_blocks(content):
+    """Отдать готовый список блоков как асинхронный поток — формат, который ждёт process_content."""
+    for block in content:
+        yield block
+
+
+async def gather_all(*aws):
+    """asyncio.gather, который при первой ошибке отменяет остальные задачи и дожидается их.
+
+    Нужен для параллельных загрузок: упавшая задача не должна оставлять соседей писать
+    в файлы, которые вызывающий код уже удаляет.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
@@ -1,22 +1,43 @@
 import asyncio
 import os
 import re
-import threading
+import time
+from urllib.parse import parse_qs, urlsplit
 
+import httpx
 import instaloader
-import requests
 from instaloader import Post
 
-from parsers.common import TEMP_DIR, generate_random_string, generate_title, logger
-
+from parsers import metrics
+from parsers.cache import FILE_CACHE_PATH, PersistentCache
+from parsers.common import (
+    SPOOL, ContentUnavailable, Variant, download_to_spool, gather_all, generate_title, http_get, logger, pick_variant,
+)
+from parsers.sources import INSTAGRAM_REGEX
 
-PARSE_INSTAGRAM = bool(int(os.getenv('PARSE_INSTAGRAM', '0')))
-INSTAGRAM_REGEX = r"(https?://)?(www\.)?instagram\.com/(reel|reels|p)/[A-Za-z0-9_-]+"
 
 # IG закрыл анонимный доступ — нужен вход под аккаунтом (session-файл instaloader).
 INSTAGRAM_USERNAME = (os.getenv('INSTAGRAM_USERNAME') or '').strip()
 INSTAGRAM_PASSWORD = (os.getenv('INSTAGRAM_PASSWORD') or '').strip()
 INSTAGRAM_SESSIONFILE = (os.getenv('INSTAGRAM_SESSIONFILE') or '').strip() or None
+# Пул сессий: "user1=/path/session1;user2" (без пути — стандартное место instaloader). Посты разных
+# чатов идут через разные сессии параллельно. Без списка — одна сессия INSTAGRAM_USERNAME.
+INSTAGRAM_SESSIONS = (os.getenv('INSTAGRAM_SESSIONS') or '').strip()
+# Не чаще одного запроса к API в N секунд с одной сессии; протухшая сессия выводится из ротации
+# и через INSTAGRAM_SESSION_COOLDOWN секунд пересоздаётся из session-файла в фоне.
+INSTAGRAM_SESSION_INTERVAL = float(os.getenv('INSTAGRAM_SESSION_INTERVAL', '2'))
+INSTAGRAM_SESSION_COOLDOWN = float(os.getenv('INSTAGRAM_SESSION_COOLDOWN', '600'))
+
+# Подпись и CDN-ссылки поста кэшируются по shortcode, пока ссылки подписаны: повторная ссылка
+# на тот же пост не тратит запрос к API сессии. Срок — по параметру oe= (hex unix-время истечения)
+# самой ранней из ссылок минус запас, но не дольше INSTAGRAM_CACHE_TTL секунд.
+INSTAGRAM_CACHE_TTL = int(os.getenv('INSTAGRAM_CACHE_TTL', str(6 * 3600)))
+INSTAGRAM_CACHE_MAX_ENTRIES = int(os.getenv('INSTAGRAM_CACHE_MAX_ENTRIES', '2000'))
+_CACHE_MARGIN = 10 * 60
+
+# Элементы карусели качаются параллельно: не больше N на пост и M по всем постам сразу.
+INSTAGRAM_POST_DOWNLOADS = int(os.getenv('INSTAGRAM_POST_DOWNLOADS', '4'))
+INSTAGRAM_DOWNLOADS = int(os.getenv('INSTAGRAM_DOWNLOADS', '8'))
 
 # Официальный graphql/doc_id у instaloader 4.15.1 IG отклоняет (403) даже с логином,
 # поэтому пост тянем через приватный web-API api/v1/media/<id>/info/ с куками сессии.
@@ -29,6 +50,9 @@ _MEDIA_IMAGE = 1
 _MEDIA_VIDEO = 2
 _MEDIA_CAROUSEL = 8
 
+# Карусель отдаётся блоками по размеру альбома Telegram: следующий качается, пока уходит текущий.
+_ALBUM_SIZE = 10
+
 # Ошибки instaloader при загрузке сессии, означающие «нужна авторизация».
 _AUTH_EXCEPTIONS = (
     instaloader.exceptions.BadResponseException,
@@ -37,37 +61,29 @@ _AUTH_EXCEPTIONS = (
     instaloader.exceptions.ConnectionException,
 )
 
-# Сессия создаётся один раз и переиспользуется; обращения к ней сериализуются.
-_lock = threading.Lock()
-_loader = None
+# Скачивание медиа по CDN-ссылкам сессии не требует и идёт вне пула.
+_download_slots = asyncio.Semaphore(INSTAGRAM_DOWNLOADS)
 
 
 class InstagramAuthRequired(Exception):
     """IG отклонил запрос (403/login wall) или нет рабочей сессии — нужна авторизация."""
 
 
-def _get_loader_locked():
-    """Вернуть авторизованный Instaloader (вызывать под _lock)."""
-    global _loader
-    if _loader is not None:
-        return _loader
-    if not INSTAGRAM_USERNAME:
-        raise InstagramAuthRequired(
-            "INSTAGRAM_USERNAME не задан — анонимный доступ к Instagram закрыт"
-        )
+def _build_loader(username, sessionfile, password):
+    """Авторизованный Instaloader из session-файла (или входом по паролю). Блокирующий."""
     L = instaloader.Instaloader(save_metadata=False, download_video_thumbnails=False)
     logged_in_by_password = False
     try:
-        L.load_session_from_file(INSTAGRAM_USERNAME, INSTAGRAM_SESSIONFILE)
-        logger.info("Instagram: сессия загружена для @%s", INSTAGRAM_USERNAME)
+        L.load_session_from_file(username, sessionfile)
+        logger.info("Instagram: сессия загружена для @%s", username)
     except FileNotFoundError as e:
-        if not INSTAGRAM_PASSWORD:
+        if not password:
             raise InstagramAuthRequired(
                 f"Нет session-файла Instagram. Выполни один раз вход: "
-                f"instaloader --login {INSTAGRAM_USERNAME}"
+                f"instaloader --login {username}"
             ) from e
-        logger.info("Instagram: session-файл не найден, вход по паролю @%s", INSTAGRAM_USERNAME)
-        L.login(INSTAGRAM_USERNAME, INSTAGRAM_PASSWORD)
+        logger.info("Instagram: session-файл не найден, вход по паролю @%s", username)
+        L.login(username, password)
         logged_in_by_password = True
     # Пустой sessionid = нерабочая сессия. Две частые причины:
     #  1) вход по паролю с сервера — IG ставит checkpoint и выдаёт ds_user_id, но НЕ sessionid;
@@ -89,10 +105,150 @@ def _get_loader_locked():
         )
     # Сессия с sessionid — сохраняем (на случай свежего логина) и переиспользуем.
     if logged_in_by_password:
-        L.save_session_to_file(INSTAGRAM_SESSIONFILE)
+        L.save_session_to_file(sessionfile)
         logger.info("Instagram: вход выполнен, сессия сохранена")
-    _loader = L
-    return _loader
+    return L
+
+
+class _Session:
+    """Сессия пула: свой Instaloader с куками, темп запросов и здоровье."""
+
+    def __init__(self, username, sessionfile, password):
+        self.username = username
+        self.sessionfile = sessionfile
+        self.password = password
+        self.loader = None
+        self.busy = False
+        self.loading = False
+        self.next_at = 0.0      # monotonic: раньше этого момента новый запрос не отправляем
+        self.retry_at = 0.0     # monotonic: когда пробовать загрузить снова после ошибки
+        self.error = None
+        self.ok = 0
+        self.failures = 0
+        self.rebuild = None     # отложенная фоновая перезагрузка протухшей сессии
+
+    @property
+    def state(self):
+        if self.loader:
+            return 'busy' if self.busy else 'ready'
+        return 'loading' if self.loading else 'expired' if self.error else 'new'
+
+
+class SessionPool:
+    """Авторизованные сессии Instagram, которые выдаются запросам параллельно.
+
+    Запрос берёт свободную сессию, дольше всех простаивавшую; одна сессия отправляет не больше
+    одного запроса за interval секунд. Сессия, которую IG отверг, выходит из ротации и через
+    cooldown секунд пересоздаётся в фоне — остальные тем временем продолжают работать.
+    """
+
+    def __init__(self, entries, interval, cooldown):
+        self._sessions = [_Session(*entry) for entry in entries]
+        self._interval = interval
+        self._cooldown = cooldown
+        self._changed = asyncio.Condition()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def states(self):
+        """{(state,): число сессий} — для метрик."""
+        counts = {}
+        for session in self._sessions:
+            counts[(session.state,)] = counts.get((session.state,), 0) + 1
+        return counts
+
+    async def _load(self, session, delay=0):
+        await asyncio.sleep(delay)
+        session.loading = True
+        try:
+            # Загрузка/логин instaloader — блокирующие, уводим в поток.
+            session.loader = await asyncio.to_thread(
+                _build_loader, session.username, session.sessionfile, session.password,
+            )
+            session.error = None
+        except Exception as e:
+            session.error = str(e) or type(e).__name__
+            session.retry_at = time.monotonic() + self._cooldown
+            logger.warning("Instagram: сессия @%s не загружена: %s", session.username, session.error)
+        finally:
+            session.loading = False
+            session.rebuild = None
+            async with self._changed:
+                self._changed.notify_all()
+
+    def _start_loads(self, now):
+        for session in self._sessions:
+            if session.loader is None and not session.loading and session.rebuild is None \
+                    and now >= session.retry_at:
+                session.loading = True
+                session.rebuild = asyncio.create_task(self._load(session))
+
+    async def acquire(self):
+        """Свободная рабочая сессия; InstagramAuthRequired, если рабочих нет и не предвидится."""
+        if not self._sessions:
+            raise InstagramAuthRequired("INSTAGRAM_USERNAME не задан — анонимный доступ к Instagram закрыт")
+        async with self._changed:
+            while True:
+                now = time.monotonic()
+                self._start_loads(now)
+                idle = [s for s in self._sessions if s.loader and not s.busy]
+                timeout = None
+                if idle:
+                    session = min(idle, key=lambda s: s.next_at)
+                    if session.next_at <= now:
+                        session.busy = True
+                        return session
+                    timeout = session.next_at - now
+                elif not any(s.loader or s.loading for s in self._sessions):
+                    errors = "; ".join(f"@{s.username}: {s.error}" for s in self._sessions if s.error)
+                    raise InstagramAuthRequired(errors or "Нет рабочей сессии Instagram")
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, session, error=None):
+        """Вернуть сессию в пул; error — IG её отверг: вывести из ротации и пересоздать позже."""
+        session.busy = False
+        session.next_at = time.monotonic() + self._interval
+        if error is None:
+            session.ok += 1
+        else:
+            session.failures += 1
+            session.loader = None
+            session.error = str(error) or type(error).__name__
+            session.retry_at = time.monotonic() + self._cooldown
+            logger.warning("Instagram: сессия @%s выведена из ротации на %.0f с: %s",
+                           session.username, self._cooldown, session.error)
+            session.rebuild = asyncio.create_task(self._load(session, delay=self._cooldown))
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def close(self):
+        tasks = [s.rebuild for s in self._sessions if s.rebuild]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _session_entries():
+    """[(username, sessionfile, password)] из INSTAGRAM_SESSIONS или одиночной сессии INSTAGRAM_USERNAME."""
+    entries = []
+    for entry in INSTAGRAM_SESSIONS.split(';'):
+        username, _, path = entry.partition('=')
+        if username.strip():
+            entries.append((username.strip(), path.strip() or None, ''))
+    if not entries and INSTAGRAM_USERNAME:
+        entries.append((INSTAGRAM_USERNAME, INSTAGRAM_SESSIONFILE, INSTAGRAM_PASSWORD))
+    return entries
+
+
+MEDIA_CACHE = PersistentCache(
+    FILE_CACHE_PATH, 'instagram_media', ttl=INSTAGRAM_CACHE_TTL, max_entries=INSTAGRAM_CACHE_MAX_ENTRIES,
+)
+SESSIONS = SessionPool(_session_entries(), INSTAGRAM_SESSION_INTERVAL, INSTAGRAM_SESSION_COOLDOWN)
+metrics.INSTAGRAM_SESSIONS.callback = SESSIONS.states
 
 
 def _csrf_token(cookies):
@@ -111,7 +267,21 @@ def _csrf_token(cookies):
     return token
 
 
-def _media_info(loader, media_id, shortcode):
+def _cookie_header(cookies, host="www.instagram.com"):
+    """Собрать заголовок Cookie для host из jar сессии instaloader.
+
+    Общий HTTP-клиент не хранит куки, поэтому передаём их явно — только те, чей домен
+    подходит к host (куки i.instagram.com на www не уходят).
+    """
+    pairs = {}
+    for c in cookies:
+        domain = (c.domain or "").lstrip(".")
+        if host == domain or host.endswith("." + domain):
+            pairs[c.name] = c.value
+    return "; ".join(f"{name}={value}" for name, value in pairs.items())
+
+
+async def _media_info(loader, media_id, shortcode):
     """Запросить api/v1/media/<id>/info/ с куками сессии. Вернуть dict первого item."""
     cookies = loader.context._session.cookies
     headers = {
@@ -121,90 +291,160 @@ def _media_info(loader, media_id, shortcode):
         "X-Requested-With": "XMLHttpRequest",
         "Referer": f"https://www.instagram.com/p/{shortcode}/",
         "Accept": "*/*",
+        "Cookie": _cookie_header(cookies),
     }
     url = f"https://www.instagram.com/api/v1/media/{media_id}/info/"
-    r = requests.get(url, headers=headers, cookies=cookies, timeout=30)
+    r = await http_get(url, headers=headers, timeout=30)
     if r.status_code in (401, 403):
         raise InstagramAuthRequired(f"Instagram отклонил запрос ({r.status_code})")
+    if r.status_code == 404:
+        raise ContentUnavailable("Пост Instagram не найден или удалён")
     # При недействительной сессии IG не отдаёт 401, а редиректит (200) на HTML-страницу
     # логина. Ловим это до r.json(), иначе падаем с «Expecting value: line 1 column 1».
-    if "/accounts/login" in r.url or "application/json" not in r.headers.get("content-type", ""):
+    if "/accounts/login" in str(r.url) or "application/json" not in r.headers.get("content-type", ""):
         raise InstagramAuthRequired(
             "Instagram вернул страницу логина — сессия недействительна, переимпортируй её"
         )
     r.raise_for_status()
     items = (r.json() or {}).get("items") or []
     if not items:
-        raise ValueError("Instagram не вернул данные поста (удалён или приватный)")
+        raise ContentUnavailable("Instagram не вернул данные поста (удалён или приватный)")
     return items[0]
 
 
+def _variants(versions):
+    return [Variant(v["url"], v.get("width"), v.get("height")) for v in versions]
+
+
 def _media_urls(node):
-    """Вернуть (kind, url) для одиночного узла (фото/видео)."""
+    """Вернуть (kind, [Variant]) для одиночного узла (фото/видео); варианты — от большего к меньшему."""
     versions = node.get("video_versions")
     if versions:
-        return "video", versions[0]["url"]
-    candidates = node["image_versions2"]["candidates"]
-    return "image", candidates[0]["url"]  # первый — максимальное разрешение
+        return "video", _variants(versions)
+    return "image", _variants(node["image_versions2"]["candidates"])
 
 
 def _collect_media(item):
-    """Список (kind, url) для поста: учитывает карусель."""
+    """Список (kind, [Variant]) для поста: учитывает карусель."""
     nodes = item.get("carousel_media") or [item]
     return [_media_urls(n) for n in nodes]
 
 
-def _download(url, ext):
-    path = os.path.join(TEMP_DIR, f"insta_{generate_random_string()}{ext}")
-    success = False
+def _links_expire(media):
+    """Unix-время истечения первой из подписанных CDN-ссылок (параметр oe=) или None."""
+    expires = []
+    for _, variants in media:
+        for v in variants:
+            oe = parse_qs(urlsplit(v.url).query).get("oe")
+            try:
+                expires.append(int(oe[0], 16))
+            except (TypeError, ValueError):
+                continue
+    return min(expires, default=None)
+
+
+def _cache_post(shortcode, caption, media):
+    expires = _links_expire(media)
+    ttl = INSTAGRAM_CACHE_TTL if expires is None else min(INSTAGRAM_CACHE_TTL, expires - time.time() - _CACHE_MARGIN)
+    if ttl <= 0:
+        return
+    MEDIA_CACHE.set(shortcode, {
+        "caption": caption,
+        "media": [[kind, [list(v) for v in variants]] for kind, variants in media],
+    }, ttl=ttl)
+
+
+def _cached_post(shortcode):
+    cached = MEDIA_CACHE.get(shortcode)
+    if cached is None:
+        return None
+    return cached["caption"], [(kind, [Variant(*v) for v in variants]) for kind, variants in cached["media"]]
+
+
+async def _download(kind, variants):
+    """Путь к файлу в спуле; небольшие картинки остаются в памяти (bytes).
+
+    Размер видео проверяется HEAD-запросом до скачивания, картинки выбираются по разрешению.
+    """
+    headers = {"User-Agent": _UA}
+    url = await pick_variant(variants, headers=headers, probe=kind == "video")
+    ext = ".mp4" if kind == "video" else ".jpg"
+    return await download_to_spool(url, "insta", ext, headers=headers, in_memory=kind == "image")
+
+
+async def _download_all(media):
+    """Скачать медиа поста параллельно, сохраняя порядок. При ошибке уже скачанное удаляется."""
+    post_slots = asyncio.Semaphore(INSTAGRAM_POST_DOWNLOADS)
+    done = []
+
+    async def fetch(kind, variants):
+        async with post_slots, _download_slots:
+            data = await _download(kind, variants)
+        done.append(data)
+        return kind, data
+
     try:
-        with requests.get(url, headers={"User-Agent": _UA}, timeout=120, stream=True) as r:
-            r.raise_for_status()
-            with open(path, "wb") as f:
-                for chunk in r.iter_content(64 * 1024):
-                    if chunk:
-                        f.write(chunk)
-        success = True
-        return path
-    finally:
-        if not success and os.path.exists(path):
-            os.remove(path)
-
-
-def _insta_load_post(normalized_url):
-    global _loader
+        return await gather_all(*(fetch(kind, variants) for kind, variants in media))
+    except BaseException:
+        for data in done:
+            if isinstance(data, str):
+                SPOOL.release(data)
+        raise
+
+
+async def _insta_load_post(normalized_url):
     m = re.search(r'/(?:reels?|p)/([A-Za-z0-9_-]+)', normalized_url, re.I)
     if not m:
         raise ValueError("Неверная ссылка Instagram")
     shortcode = m.group(1)
+    cached = _cached_post(shortcode)
+    if cached is not None:
+        logger.debug("Instagram: shortcode=%s из кэша (%s)", shortcode, MEDIA_CACHE.stats())
+        return shortcode, *cached
     media_id = Post.shortcode_to_mediaid(shortcode)
-    with _lock:
+    # Сессию, которую IG отверг, пул выводит из ротации — пробуем следующую.
+    for attempt in range(len(SESSIONS) or 1):
+        session = await SESSIONS.acquire()
         try:
-            loader = _get_loader_locked()
-            item = _media_info(loader, media_id, shortcode)
-        except _AUTH_EXCEPTIONS as e:
-            _loader = None  # сессия могла протухнуть — пересоздадим при следующей попытке
-            raise InstagramAuthRequired(str(e) or "Instagram отклонил запрос") from e
-        except InstagramAuthRequired:
-            _loader = None
+            item = await _media_info(session.loader, media_id, shortcode)
+        except (InstagramAuthRequired, *_AUTH_EXCEPTIONS) as e:
+            await SESSIONS.release(session, e)
+            if attempt == len(SESSIONS) - 1:
+                if isinstance(e, InstagramAuthRequired):
+                    raise
+                raise InstagramAuthRequired(str(e) or "Instagram отклонил запрос") from e
+            continue
+        except BaseException:
+            await SESSIONS.release(session)
             raise
+        await SESSIONS.release(session)
+        break
     caption = ((item.get("caption") or {}).get("text") or "").strip()
     media = _collect_media(item)
     logger.debug("Instagram: shortcode=%s, медиа=%s", shortcode, len(media))
-    imgs, vids = [], []
-    for kind, url in media:
-        if kind == "video":
-            vids.append(_download(url, ".mp4"))
-        else:
-            imgs.append(_download(url, ".jpg"))
-    content = []
+    _cache_post(shortcode, caption, media)
+    return shortcode, caption, media
+
+
+async def _post_blocks(shortcode, caption, media):
+    """Блоки поста: подпись сразу, медиа — пачками по альбому, каждая качается перед своей отправкой."""
     if caption:
-        content.append({"text": caption})
-    if imgs:
-        content.append({"image_files": imgs})
-    if vids:
-        content.append({"video_files": vids})
-    return caption, content
+        yield {"text": caption}
+    for i in range(0, len(media), _ALBUM_SIZE):
+        imgs, vids = [], []
+        try:
+            downloaded = await _download_all(media[i:i + _ALBUM_SIZE])
+        except httpx.HTTPStatusError:
+            MEDIA_CACHE.delete(shortcode)  # CDN отверг ссылку раньше oe= — в следующий раз спросим API
+            raise
+        for kind, path in downloaded:
+            (vids if kind == "video" else imgs).append(path)
+        block = {}
+        if imgs:
+            block["image_files"] = imgs
+        if vids:
+            block["video_files"] = vids
+        yield block
 
 
 async def get_instagram_content(url, user):
@@ -215,6 +455,6 @@ async def get_instagram_content(url, user):
     norm = m.group(0).split("?")[0]
     if not norm.startswith("http"):
         norm = "https://www." + norm.lstrip("./")
-    caption, content = await asyncio.to_thread(_insta_load_post, norm)
+    shortcode, caption, media = await _insta_load_post(norm)
     title = generate_title(user, url)
-    return title, content
+    return title, _post_blocks(shortcode, caption, media)
@@ -0,0 +1,188 @@
+import asyncio
+import os
+import re
+import time
+
+import imageio_ffmpeg
+
+from parsers import metrics
+from parsers.common import SPOOL, UPLOAD_SIZE_CAP, logger
+
+
+FFMPEG_MAX_CONCURRENCY = int(os.getenv('FFMPEG_MAX_CONCURRENCY', '2'))
+# Перекодирование в H.264 занимает минуты — у него свой лимит, чтобы не стопорить быстрые
+# probe и копирование дорожек.
+FFMPEG_TRANSCODE_CONCURRENCY = int(os.getenv('FFMPEG_TRANSCODE_CONCURRENCY', '1'))
+FFMPEG_TIMEOUT = int(os.getenv('FFMPEG_TIMEOUT', '300'))
+FFMPEG_TRANSCODE_TIMEOUT = int(os.getenv('FFMPEG_TRANSCODE_TIMEOUT', '900'))
+
+_ffmpeg_slots = asyncio.Semaphore(FFMPEG_MAX_CONCURRENCY)
+_transcode_slots = asyncio.Semaphore(FFMPEG_TRANSCODE_CONCURRENCY)
+
+# Варианты кодеков при склейке: сначала чистое копирование дорожек, потом перекодирование
+# только аудио и лишь в крайнем случае — всего ролика.
+_MUX_CODECS = (
+    ('-c', 'copy'),
+    ('-c:v', 'copy', '-c:a', 'aac'),
+    ('-c:v', 'libx264', '-preset', 'veryfast', '-c:a', 'aac'),
+)
+
+
+# Что Telegram гарантированно показывает как видео, а не как файл.
+_PLAYABLE_VIDEO_CODECS = ('h264', 'hevc')
+_PLAYABLE_AUDIO_CODECS = (None, 'aac', 'mp3')
+_FIT_AUDIO_BITRATE = 96_000
+_FIT_MIN_VIDEO_BITRATE = 150_000
+_FIT_SIZE_MARGIN = 0.92  # битрейт у x264 плавает, целимся чуть ниже лимита
+
+_DURATION_REGEX = re.compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+_CONTAINER_REGEX = re.compile(r'Input #0, ([\w,]+), from')
+_STREAM_REGEX = re.compile(r'Stream #0:\d+.*?: (Video|Audio): (\w+)')
+
+
+class FFmpegError(Exception):
+    """ffmpeg завершился с ошибкой."""
+
+
+class FFmpegTimeout(FFmpegError):
+    """ffmpeg не уложился в таймаут и был остановлен."""
+
+
+async def run_ffmpeg(*args, timeout=FFMPEG_TIMEOUT, transcode=False):
+    """Запустить ffmpeg как asyncio-подпроцесс. При таймауте или отмене задачи процесс убивается.
+
+    transcode — перекодирование видео: занимает слот отдельного лимита FFMPEG_TRANSCODE_CONCURRENCY.
+    """
+    async with _transcode_slots if transcode else _ffmpeg_slots:
+        start = time.perf_counter()
+        proc = await asyncio.create_subprocess_exec(
+            imageio_ffmpeg.get_ffmpeg_exe(), '-hide_banner', '-nostdin', '-y', *args,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            _, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            metrics.FFMPEG_SECONDS.observe(time.perf_counter() - start, 'timeout')
+            raise FFmpegTimeout(f"ffmpeg не уложился в {timeout} с") from None
+        except asyncio.CancelledError:
+            proc.kill()
+            await proc.wait()
+            raise
+        metrics.FFMPEG_SECONDS.observe(time.perf_counter() - start, 'ok' if proc.returncode == 0 else 'error')
+    stderr = stderr.decode(errors='replace')
+    if proc.returncode != 0:
+        raise FFmpegError(f"ffmpeg завершился с кодом {proc.returncode}: {stderr[-500:]}")
+    logger.debug("FFmpeg output: %s", stderr)
+    return stderr
+
+
+async def mux(video_path, audio_path, output_path):
+    """Склеить видео- и аудиодорожку в mp4, перекодируя только то, что не копируется как есть."""
+    last_error = None
+    for codecs in _MUX_CODECS:
+        try:
+            await run_ffmpeg(
+                '-i', video_path, '-i', audio_path,
+                '-map', '0:v:0', '-map', '1:a:0',
+                *codecs, '-movflags', '+faststart',
+                output_path, transcode='libx264' in codecs,
+            )
+            return output_path
+        except FFmpegTimeout:
+            raise  # перекодирование заведомо дольше копирования
+        except FFmpegError as e:
+            logger.warning("Склейка с %s не удалась: %s", ' '.join(codecs), e)
+            last_error = e
+    raise last_error
+
+
+async def probe(path):
+    """(контейнеры, длительность в секундах или None, видеокодек, аудиокодек) по выводу ffmpeg -i."""
+    info = await run_ffmpeg('-i', path, '-t', '0', '-f', 'null', '-', timeout=60)
+    container = _CONTAINER_REGEX.search(info)
+    duration = _DURATION_REGEX.search(info)
+    codecs = {}
+    for kind, codec in _STREAM_REGEX.findall(info):
+        codecs.setdefault(kind, codec)
+    return (
+        container.group(1).split(',') if container else [],
+        int(duration[1]) * 3600 + int(duration[2]) * 60 + float(duration[3]) if duration else None,
+        codecs.get('Video'),
+        codecs.get('Audio'),
+    )
+
+
+async def _transcode(path, output_path, video_bitrate=None):
+    rate = ('-crf', '23') if video_bitrate is None else (
+        '-b:v', str(video_bitrate), '-maxrate', str(video_bitrate), '-bufsize', str(video_bitrate * 2),
+    )
+    # При низком битрейте высокое разрешение только мылит картинку — ужимаем до 720p.
+    scale = ('-vf', 'scale=-2:min(ih\\,720)') if video_bitrate and video_bitrate < 2_000_000 else ()
+    await run_ffmpeg(
+        '-i', path, '-map', '0:v:0', '-map', '0:a:0?',
+        '-c:v', 'libx264', '-preset', 'veryfast', *rate, *scale, '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-b:a', str(_FIT_AUDIO_BITRATE), '-movflags', '+faststart',
+        output_path, timeout=FFMPEG_TRANSCODE_TIMEOUT, transcode=True,
+    )
+
+
+async def fit_video(data, max_bytes=UPLOAD_SIZE_CAP):
+    """Привести видео к тому, что Telegram примет и покажет: mp4 (H.264/HEVC, AAC) не больше max_bytes.
+
+    data — путь к файлу спула или bytes. Возвращает годный вариант: исходный или новый файл спула
+    (исходный файл тогда освобождается). Если перекодировать не вышло, а размер в лимите, отдаёт
+    исходник как есть; если видео больше лимита — ValueError, исходник не трогается.
+    """
+    if isinstance(data, bytes):
+        if data[4:8] == b'ftyp':
+            return data  # небольшой mp4 из памяти
+        path = SPOOL.allocate('fit_src', '.bin')
+        with open(path, 'wb') as f:
+            f.write(data)
+        SPOOL.account(path)
+        try:
+            return await fit_video(path, max_bytes)
+        except BaseException:
+            SPOOL.release(path)
+            raise
+
+    path = data
+    size = os.path.getsize(path)
+    containers, duration, video_codec, audio_codec = await probe(path)
+    playable = ('mp4' in containers and video_codec in _PLAYABLE_VIDEO_CODECS
+                and audio_codec in _PLAYABLE_AUDIO_CODECS)
+    if playable and size <= max_bytes:
+        return path
+
+    output_path = SPOOL.allocate('fit', '.mp4')
+    try:
+        bitrate = None
+        if size > max_bytes:
+            if not duration:
+                raise ValueError(f"Видео {size // 2 ** 20} МБ больше лимита Telegram, а длительность неизвестна")
+            bitrate = int(max_bytes * 8 * _FIT_SIZE_MARGIN / duration) - _FIT_AUDIO_BITRATE
+            if bitrate < _FIT_MIN_VIDEO_BITRATE:
+                raise ValueError(f"Видео {size // 2 ** 20} МБ слишком длинное, чтобы ужать его до лимита Telegram")
+        logger.info("Перекодирование видео: %s МБ, %s/%s в %s, битрейт %s",
+                    size // 2 ** 20, video_codec, audio_codec, ','.join(containers), bitrate or 'crf')
+        await _transcode(path, output_path, bitrate)
+        if bitrate and os.path.getsize(output_path) > max_bytes:
+            bitrate = int(bitrate * max_bytes / os.path.getsize(output_path) * _FIT_SIZE_MARGIN)
+            await _transcode(path, output_path, bitrate)
+        if os.path.getsize(output_path) > max_bytes:
+            raise ValueError("Видео не удалось ужать до лимита Telegram")
+    except FFmpegError as e:
+        SPOOL.release(output_path)
+        if size > max_bytes:
+            raise ValueError(f"Видео больше лимита Telegram, перекодировать не удалось: {e}") from e
+        logger.warning("Перекодирование не удалось, отправляем как есть: %s", e)
+        return path
+    except BaseException:
+        SPOOL.release(output_path)
+        raise
+    SPOOL.account(output_path)
+    SPOOL.release(path)
+    return output_path
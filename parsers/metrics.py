@@ -0,0 +1,200 @@
+"""Метрики бота в текстовом формате Prometheus и локальный HTTP-эндпоинт для них.
+
+Сборщик (Prometheus, VictoriaMetrics, curl) читает http://METRICS_HOST:METRICS_PORT/metrics.
+Метрики обновляются только из event loop, поэтому блокировок нет.
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from urllib.parse import urlsplit
+
+
+# Не импортируем parsers.common: он сам пишет метрики скачиваний.
+logger = logging.getLogger('trash_meme_bot')
+
+TEMP_DIR = os.getenv('TEMP_DIR')
+
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT') or '0')  # 0 — эндпоинт выключен
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+BYTES_BUCKETS = tuple(2 ** p for p in range(14, 29, 2))  # 16 КБ .. 256 МБ
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def _header(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = self._header()
+        for labels, value in self._values.items():
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Gauge(_Metric):
+    """Значение считается в момент чтения: callback() -> {labels_tuple: value} или число."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), callback=None):
+        super().__init__(name, help_text, labelnames)
+        self.callback = callback
+
+    def render(self):
+        lines = self._header()
+        if self.callback is None:
+            return lines
+        try:
+            values = self.callback()
+        except Exception as e:
+            logger.warning("Метрика %s не посчитана: %s", self.name, e)
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self):
+        lines = self._header()
+        for labels, (counts, total, count) in self._series.items():
+            for bound, n in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, [("le", bound)])} {n}')
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, [("le", "+Inf")])} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+def site(url):
+    """Домен второго уровня для метки: cdninstagram.com, а не scontent-arn2-1.cdninstagram.com."""
+    host = urlsplit(str(url)).hostname or ''
+    return '.'.join(host.split('.')[-2:])
+
+
+def _temp_dir_usage():
+    files = size = 0
+    if TEMP_DIR and os.path.isdir(TEMP_DIR):
+        with os.scandir(TEMP_DIR) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    files += 1
+                    size += entry.stat(follow_symlinks=False).st_size
+    return {('bytes',): size, ('files',): files}
+
+
+PARSE_SECONDS = Histogram('meme_bot_parse_seconds', 'Время разбора ссылки до заголовка', ['parser'])
+DOWNLOAD_SECONDS = Histogram('meme_bot_download_seconds', 'Длительность скачивания медиа', ['site'])
+DOWNLOAD_BYTES = Histogram('meme_bot_download_bytes', 'Размер скачанного медиа', ['site'], BYTES_BUCKETS)
+FFMPEG_SECONDS = Histogram('meme_bot_ffmpeg_seconds', 'Длительность процесса ffmpeg', ['outcome'])
+SEND_SECONDS = Histogram('meme_bot_telegram_send_seconds', 'Задержка вызова Bot API', ['method'])
+SEND_WAIT_SECONDS = Histogram('meme_bot_telegram_throttle_seconds', 'Ожидание лимитов Telegram перед вызовом')
+SEND_RETRIES = Counter('meme_bot_telegram_retries_total', 'Повторы отправки в Telegram', ['reason'])
+URL_VIDEOS = Counter('meme_bot_url_videos_total', 'Видео, отданные Telegram ссылкой', ['outcome'])
+QUEUE_DEPTH = Gauge('meme_bot_queue_depth', 'Задач в очередях чатов')
+JOB_STATES = Gauge('meme_bot_jobs', 'Задачи в очереди на диске по состояниям', ['state'])
+SPOOL_BYTES = Gauge('meme_bot_spool_bytes', 'Учтено в лимите спула временных файлов')
+CACHE_LOOKUPS = Gauge('meme_bot_cache_lookups', 'Обращения к кэшам с начала работы', ['cache', 'outcome'])
+INSTAGRAM_SESSIONS = Gauge('meme_bot_instagram_sessions', 'Сессии Instagram по состояниям', ['state'])
+STARTUP_SECONDS = Gauge('meme_bot_startup_seconds', 'Длительность старта бота по этапам', ['phase'])
+TEMP_DIR_USAGE = Gauge('meme_bot_temp_dir', 'Занято в TEMP_DIR', ['unit'], callback=_temp_dir_usage)
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+async def _handle(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 10)
+        while (await asyncio.wait_for(reader.readline(), 10)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', render().encode()
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server():
+    """Поднять эндпоинт /metrics, если задан METRICS_PORT. Вернуть asyncio.Server или None."""
+    if not METRICS_PORT:
+        return None
+    server = await asyncio.start_server(_handle, METRICS_HOST, METRICS_PORT)
+    logger.info("Метрики: http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    return server
@@ -1,27 +1,23 @@
-import asyncio
-import os
-import requests
 from bs4 import BeautifulSoup
 
-from parsers.common import build_http_headers, generate_title, logger
-
-
-PARSE_PIKABU = bool(int(os.getenv('PARSE_PIKABU', '0')))
-PIKABU_REGEX = r"(https?://)?(www\.)?pikabu\.ru(/[^\s]*)?|link=https%3A%2F%2Fpikabu\.ru%2F[^\s]+"
+from parsers.common import ContentUnavailable, generate_title, http_get, iter_blocks, logger
 
 
 async def get_pikabu_content(url, user):
-    return await asyncio.to_thread(_get_pikabu_content_sync, url, user)
-
-
-def _get_pikabu_content_sync(url, user):
     logger.debug("Get pikabu url %s", url)
     url_parts = url.split('\n')
     modify_url = url_parts[1] if len(url_parts) > 1 else url_parts[0]
     logger.debug("Get pikabu modify url %s", modify_url)
-    response = requests.get(modify_url, headers=build_http_headers(), timeout=30)
+    response = await http_get(modify_url, timeout=30)
+    if response.status_code in (404, 410):
+        raise ContentUnavailable("Пост Pikabu не найден или удалён")
     response.raise_for_status()
-    soup = BeautifulSoup(response.text, 'html.parser')
+    title, content = _parse_pikabu_page(response.text, url, user)
+    return title, iter_blocks(content)
+
+
+def _parse_pikabu_page(html, url, user):
+    soup = BeautifulSoup(html, 'html.parser')
 
     title = soup.find('h1', class_='story__title')
     title = title.text.strip() if title else 'No Title'
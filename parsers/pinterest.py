@@ -1,32 +1,49 @@
-import asyncio
-import os
 import re
 
-import requests
 from bs4 import BeautifulSoup
 
-from parsers.common import build_http_headers, generate_title, logger
+from parsers.common import (
+    URL_PHOTO_SIZE_CAP, Variant, generate_title, http_get, iter_blocks, logger, pick_variant,
+)
+from parsers.sources import PINTEREST_REGEX
 
 
-PARSE_PINTEREST = bool(int(os.getenv('PARSE_PINTEREST', '0')))
-PINTEREST_REGEX = r"(https?://)?(www\.)?((pinterest\.[a-z.]+/pin/[^\s]+)|(pin\.it/[^\s]+))"
+# i.pinimg.com/<размер>/aa/bb/cc/<hash>.jpg: размер — originals или ширина вида 736x.
+_PINIMG_REGEX = re.compile(r'^(https://i\.pinimg\.com/)(originals|\d+x)(/.+)$')
+_PINIMG_SIZES = (('originals', None), ('736x', 736))
 
 
 async def get_pinterest_content(url, user):
-    return await asyncio.to_thread(_get_pinterest_content_sync, url, user)
-
-
-def _get_pinterest_content_sync(url, user):
     logger.debug("Get pinterest url %s", url)
     match = re.search(PINTEREST_REGEX, url, re.IGNORECASE)
     if match:
         url = match.group(0)
-    headers = build_http_headers()
-    response = requests.get(url, allow_redirects=True, headers=headers, timeout=30)
-    modify_url = response.url
-    logger.debug("Get pinterest modify url %s", modify_url)
+    if not url.startswith('http'):
+        url = 'https://' + url
+    response = await http_get(url, timeout=30)
+    logger.debug("Get pinterest modify url %s", response.url)
+    title, content = _parse_pinterest_page(response.text, url, user)
+    for block in content:
+        if 'images' in block:
+            block['images'] = [
+                await pick_variant(_pinimg_variants(u), max_bytes=URL_PHOTO_SIZE_CAP) for u in block['images']
+            ]
+    return title, iter_blocks(content)
+
+
+def _pinimg_variants(image_url):
+    """Оригинал и уменьшенная копия картинки pinimg; og:image обычно ведёт на 736x."""
+    m = _PINIMG_REGEX.match(image_url)
+    if not m:
+        return [Variant(image_url)]
+    variants = [Variant(f'{m.group(1)}{size}{m.group(3)}', width) for size, width in _PINIMG_SIZES]
+    if m.group(2) not in dict(_PINIMG_SIZES):
+        variants.append(Variant(image_url, int(m.group(2)[:-1])))
+    return variants
+
 
-    soup = BeautifulSoup(response.text, 'html.parser')
+def _parse_pinterest_page(html, url, user):
+    soup = BeautifulSoup(html, 'html.parser')
 
     title = generate_title(user, url)
     content = []
@@ -40,7 +57,7 @@ def _get_pinterest_content_sync(url, user):
     if pin_text:
         content.append({'text': pin_text})
 
-    video_match = re.search(r'https://v\d+\.pinimg\.com/videos/[^"]+\.mp4', response.text)
+    video_match = re.search(r'https://v\d+\.pinimg\.com/videos/[^"]+\.mp4', html)
     if video_match:
         video_url = video_match.group(0)
         content.append({'videos': [video_url]})
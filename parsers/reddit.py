@@ -1,20 +1,31 @@
 import asyncio
 import os
-import subprocess
+import re
 import xml.etree.ElementTree as ET
+from collections import OrderedDict
 from urllib.parse import urlparse
 
 import asyncpraw
-import imageio_ffmpeg
-import requests
-from moviepy.audio.io.AudioFileClip import AudioFileClip
-from moviepy.video.io.VideoFileClip import VideoFileClip
 
-from parsers.common import TEMP_DIR, build_http_headers, generate_random_string, generate_title, logger
+from parsers.common import (
+    SPOOL, URL_PHOTO_SIZE_CAP, ContentUnavailable, Variant, download_to_file, gather_all, generate_title,
+    http_get, logger, pick_variant, resolve_redirects,
+)
+from parsers.media import FFmpegError, mux, run_ffmpeg
+from parsers.sources import PARSE_REDDIT, REDDIT_REGEX
 
 
-PARSE_REDDIT = bool(int(os.getenv('PARSE_REDDIT', '0')))
-REDDIT_REGEX = r"(https?://)?(www\.)?reddit\.com/[^\s]+"
+_SUBMISSION_ID_REGEX = re.compile(r"/comments/([a-z0-9]+)", re.IGNORECASE)
+
+# Короткие ссылки /r/<sub>/s/<code> -> id поста; редиректы у них не меняются.
+_SHORT_LINK_CACHE_SIZE = 2048
+_short_links = OrderedDict()
+
+# Запросы постов, пришедшие почти одновременно, уходят одним info(fullnames=...).
+_BATCH_WINDOW = 0.05
+_BATCH_LIMIT = 100  # столько fullnames Reddit принимает за раз
+_pending = {}
+_flush_task = None
 
 
 if PARSE_REDDIT:
@@ -30,9 +41,69 @@ async def close():
         await reddit_client.close()
 
 
-def parse_mpd_file(mpd_path):
-    tree = ET.parse(mpd_path)
-    root = tree.getroot()
+async def resolve_submission_id(url):
+    """id поста по ссылке: из канонического /comments/<id>/ — локально, share-ссылки — по редиректам."""
+    m = _SUBMISSION_ID_REGEX.search(url)
+    if m:
+        return m.group(1).lower()
+    submission_id = _short_links.get(url)
+    if submission_id:
+        _short_links.move_to_end(url)
+        return submission_id
+    final = await resolve_redirects(url, done=_SUBMISSION_ID_REGEX.search)
+    logger.debug("Get reddit modify url %s", final)
+    m = _SUBMISSION_ID_REGEX.search(final)
+    if not m:
+        raise ValueError("Не удалось определить пост Reddit по ссылке")
+    submission_id = _short_links[url] = m.group(1).lower()
+    if len(_short_links) > _SHORT_LINK_CACHE_SIZE:
+        _short_links.popitem(last=False)
+    return submission_id
+
+
+async def _flush_batch():
+    global _flush_task
+    await asyncio.sleep(_BATCH_WINDOW)
+    batch = dict(_pending)
+    _pending.clear()
+    _flush_task = None  # запросы, пришедшие во время выборки, соберутся в следующую пачку
+    ids = list(batch)
+    found = {}
+    try:
+        for i in range(0, len(ids), _BATCH_LIMIT):
+            fullnames = [f't3_{submission_id}' for submission_id in ids[i:i + _BATCH_LIMIT]]
+            async for submission in reddit_client.info(fullnames=fullnames):
+                found[submission.id] = submission
+    except Exception as e:
+        for future in batch.values():
+            if not future.done():
+                future.set_exception(e)
+        return
+    logger.debug("Reddit: пачка из %s постов, найдено %s", len(ids), len(found))
+    for submission_id, future in batch.items():
+        if future.done():
+            continue
+        if submission_id in found:
+            future.set_result(found[submission_id])
+        else:
+            future.set_exception(ContentUnavailable("Пост Reddit не найден или удалён"))
+
+
+async def fetch_submission(submission_id):
+    """Получить пост через общий батч info(fullnames=...) вместе с другими одновременными запросами."""
+    global _flush_task
+    future = _pending.get(submission_id)
+    if future is None:
+        future = _pending[submission_id] = asyncio.get_running_loop().create_future()
+        if _flush_task is None:
+            _flush_task = asyncio.create_task(_flush_batch())
+    # shield: отмена одного ожидающего не должна отменять общий результат для остальных.
+    return await asyncio.shield(future)
+
+
+def parse_mpd_file(mpd_content):
+    """Относительный URL аудиодорожки с максимальным битрейтом из содержимого DASH MPD."""
+    root = ET.fromstring(mpd_content)
     namespaces = {'ns': 'urn:mpeg:dash:schema:mpd:2011'}
 
     max_audio_bandwidth = 0
@@ -50,140 +121,118 @@ def parse_mpd_file(mpd_path):
     return max_audio_url
 
 
-def download_reddit_video(video_url, hls_url=None):
-    video_file_name = None
-    audio_file_name = None
-    mpd_file_name = None
-
-    try:
-        ffmpeg_path = imageio_ffmpeg.get_ffmpeg_exe()
+async def _download_dash_audio(base_url, audio_path):
+    """Скачать лучшую аудиодорожку из DASHPlaylist.mpd. None, если у ролика нет звука."""
+    mpd_response = await http_get(base_url + "DASHPlaylist.mpd", timeout=30)
+    mpd_response.raise_for_status()
+    audio_relative = parse_mpd_file(mpd_response.content)
+    if not audio_relative:
+        return None
+    await download_to_file(base_url + audio_relative, audio_path, timeout=30)
+    if os.path.getsize(audio_path) == 0:
+        raise Exception("Аудио файл не был создан или пуст")
+    return audio_path
 
-        if hls_url:
-            output_file_name = f'compiled_video_{generate_random_string()}.mp4'
-            output_path = os.path.join(TEMP_DIR, output_file_name)
-            result = subprocess.run(
-                [
-                    ffmpeg_path,
-                    "-y",
-                    "-i",
-                    hls_url,
-                    "-map", "0:v:0",
-                    "-map", "0:a:0",
-                    "-c", "copy",
-                    output_path,
-                ],
-                check=True,
-                capture_output=True,
-                text=True,
-                timeout=300,
-            )
-            if result.stderr:
-                logger.debug("FFmpeg output: %s", result.stderr)
-            return output_path
 
-        video_file_name = os.path.join(TEMP_DIR, f'temp_video_{generate_random_string()}.mp4')
-        video_response = requests.get(video_url, timeout=30)
-        video_response.raise_for_status()
+async def download_reddit_video(video_url, hls_url=None):
+    """Скачать ролик в файл спула (освобождает вызывающий код через SPOOL.release)."""
+    temp_files = []
 
-        with open(video_file_name, 'wb') as video_file:
-            video_file.write(video_response.content)
+    def temp_path(prefix, ext):
+        path = SPOOL.allocate(prefix, ext)
+        temp_files.append(path)
+        return path
 
-        if not os.path.exists(video_file_name) or os.path.getsize(video_file_name) == 0:
-            raise Exception("Видео файл не был создан или пуст")
+    result = None
+    try:
+        if hls_url:
+            output_path = temp_path('reddit_mux', '.mp4')
+            await run_ffmpeg('-i', hls_url, '-map', '0:v:0', '-map', '0:a:0', '-c', 'copy', output_path)
+            SPOOL.account(output_path)
+            result = output_path
+            return result
 
+        video_file_name = temp_path('reddit_video', '.mp4')
         if "DASH_" not in video_url:
-            return video_file_name
-
-        mpd_url = video_url.split("DASH_")[0] + "DASHPlaylist.mpd"
-        mpd_file_name = os.path.join(TEMP_DIR, f'temp_playlist_{generate_random_string()}.mpd')
-
-        mpd_response = requests.get(mpd_url, timeout=30)
-        mpd_response.raise_for_status()
-
-        with open(mpd_file_name, 'wb') as f:
-            f.write(mpd_response.content)
-
-        audio_relative = parse_mpd_file(mpd_file_name)
-        if not audio_relative:
-            if os.path.exists(mpd_file_name):
-                os.remove(mpd_file_name)
-            return video_file_name
-        audio_url = video_url.split("DASH_")[0] + audio_relative
-
-        audio_file_name = os.path.join(TEMP_DIR, f'temp_audio_{generate_random_string()}.mp4')
-        audio_response = requests.get(audio_url, timeout=30)
-        audio_response.raise_for_status()
-
-        with open(audio_file_name, 'wb') as audio_file:
-            audio_file.write(audio_response.content)
+            await download_to_file(video_url, video_file_name, timeout=30)
+            audio_file_name = None
+        else:
+            # Видео качается параллельно с MPD и аудио: время ≈ самый долгий из потоков.
+            _, audio_file_name = await gather_all(
+                download_to_file(video_url, video_file_name, timeout=30),
+                _download_dash_audio(video_url.split("DASH_")[0], temp_path('reddit_audio', '.mp4')),
+            )
 
-        if not os.path.exists(audio_file_name) or os.path.getsize(audio_file_name) == 0:
-            raise Exception("Аудио файл не был создан или пуст")
+        if os.path.getsize(video_file_name) == 0:
+            raise Exception("Видео файл не был создан или пуст")
 
-        output_path = os.path.join(TEMP_DIR, f'compiled_video_{generate_random_string()}.mp4')
-        temp_audio_path = os.path.join(TEMP_DIR, f'temp-audio-{generate_random_string()}.m4a')
+        if not audio_file_name:
+            result = video_file_name
+            return result
 
+        output_path = temp_path('reddit_mux', '.mp4')
         try:
-            video_clip = VideoFileClip(video_file_name)
-            audio_clip = AudioFileClip(audio_file_name)
-
-            if video_clip.duration == 0 or audio_clip.duration == 0:
-                raise Exception("Некорректная длительность видео или аудио")
-
-            video_clip.audio = audio_clip
-            video_clip.write_videofile(
-                output_path,
-                codec='libx264',
-                audio_codec='aac',
-                temp_audiofile=temp_audio_path,
-                remove_temp=True,
-                logger=None
-            )
-
-            video_clip.close()
-            audio_clip.close()
-        except Exception as e:
+            await mux(video_file_name, audio_file_name, output_path)
+        except FFmpegError as e:
             logger.error("Ошибка при обработке видео: %s", e)
-            for leftover in (audio_file_name, mpd_file_name):
-                if leftover and os.path.exists(leftover):
-                    os.remove(leftover)
-            return video_file_name
+            result = video_file_name  # лучше видео без звука, чем ничего
+            return result
 
-        os.remove(video_file_name)
-        os.remove(audio_file_name)
-        os.remove(mpd_file_name)
-
-        return output_path
+        SPOOL.account(output_path)
+        result = output_path
+        return result
     except Exception as e:
         logger.error("Ошибка при скачивании видео: %s", e)
-        if video_file_name and os.path.exists(video_file_name):
-            os.remove(video_file_name)
-        if audio_file_name and os.path.exists(audio_file_name):
-            os.remove(audio_file_name)
-        if mpd_file_name and os.path.exists(mpd_file_name):
-            os.remove(mpd_file_name)
         raise
+    finally:
+        for path in temp_files:
+            if path != result:
+                SPOOL.release(path)
 
 
 async def get_reddit_content(url, user):
     logger.debug("Get reddit url %s", url)
-    response = await asyncio.to_thread(
-        requests.get, url, allow_redirects=True, headers=build_http_headers(), timeout=30,
-    )
-    response.raise_for_status()
-    modify_url = response.url
-    logger.debug("Get reddit modify url %s", modify_url)
+    m = re.search(REDDIT_REGEX, url, re.IGNORECASE)
+    link = m.group(0) if m else url
+    if not link.startswith('http'):
+        link = 'https://' + link
+    submission = await fetch_submission(await resolve_submission_id(link))
+    title = generate_title(user, url, submission.title)
+    return title, _submission_blocks(submission)
 
-    submission = await reddit_client.submission(url=modify_url)
-    title = submission.title
-    title = generate_title(user, url, title)
-    content = []
 
+def _unescape(url):
+    return url.replace('&amp;', '&')
+
+
+def _gallery_variants(meta):
+    """Оригинал и превью картинки галереи (media_metadata), от большего к меньшему."""
+    source = meta.get('s') or {}
+    variants = [Variant(_unescape(source['u']), source.get('x'), source.get('y'))] if source.get('u') else []
+    previews = sorted(meta.get('p') or [], key=lambda p: p.get('x') or 0, reverse=True)
+    return variants + [Variant(_unescape(p['u']), p.get('x'), p.get('y')) for p in previews if p.get('u')]
+
+
+def _preview_variants(submission):
+    """Ссылка поста на картинку и её превью от Reddit, от большего к меньшему."""
+    images = (getattr(submission, 'preview', None) or {}).get('images') or []
+    if not images:
+        return [Variant(submission.url)]
+    source = images[0].get('source') or {}
+    previews = sorted(images[0].get('resolutions') or [], key=lambda p: p.get('width') or 0, reverse=True)
+    return [Variant(submission.url, source.get('width'), source.get('height'))] + [
+        Variant(_unescape(p['url']), p.get('width'), p.get('height')) for p in previews if p.get('url')
+    ]
+
+
+async def _submission_blocks(submission):
+    """Блоки поста по порядку; видео скачивается и склеивается, пока уходят текст и картинки."""
     if submission.selftext:
-        content.append({'text': submission.selftext})
+        yield {'text': submission.selftext}
 
     if submission.url and urlparse(submission.url).path.lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
-        content.append({'images': [submission.url]})
+        # Картинку по URL Telegram качает сам и только до 5 МБ — иначе берём превью поменьше.
+        yield {'images': [await pick_variant(_preview_variants(submission), max_bytes=URL_PHOTO_SIZE_CAP)]}
 
     is_gallery = getattr(submission, 'is_gallery', False)
     if is_gallery:
@@ -196,17 +245,19 @@ async def get_reddit_content(url, user):
             source = meta.get('s', {})
             kind = meta.get('e', 'Image')
             if kind == 'Image':
-                u = source.get('u')
-                if u:
-                    gallery_images.append(u.replace('&amp;', '&'))
+                variants = _gallery_variants(meta)
+                if variants:
+                    gallery_images.append(variants)
             else:  # AnimatedImage / RedditVideo
                 u = source.get('mp4') or source.get('gif')
                 if u:
-                    gallery_videos.append(u.replace('&amp;', '&'))
+                    gallery_videos.append(_unescape(u))
         if gallery_images:
-            content.append({'images': gallery_images})
+            yield {'images': list(await gather_all(
+                *(pick_variant(variants, max_bytes=URL_PHOTO_SIZE_CAP) for variants in gallery_images)
+            ))}
         if gallery_videos:
-            content.append({'videos': gallery_videos})
+            yield {'videos': gallery_videos}
 
     if submission.media and 'reddit_video' in submission.media:
         video_data = submission.media['reddit_video'] or {}
@@ -215,10 +266,10 @@ async def get_reddit_content(url, user):
 
         if video_url:
             try:
-                compiled_video_path = await asyncio.to_thread(download_reddit_video, video_url, hls_url=hls_url)
-                content.append({'video_files': [compiled_video_path]})
+                compiled_video_path = await download_reddit_video(video_url, hls_url=hls_url)
+                block = {'video_files': [compiled_video_path]}
             except Exception as e:
                 logger.error("Ошибка при обработке видео Reddit: %s", e)
-                content.append({'videos': [video_url]})
+                block = {'videos': [video_url]}
+            yield block
 
-    return title, content
@@ -0,0 +1,99 @@
+"""Реестр источников: флаг, хосты и регулярка ссылки — без импорта самого парсера.
+
+Модуль парсера тянет тяжёлые зависимости (instaloader, asyncpraw, bs4), поэтому он
+импортируется только для включённого источника (PARSE_*=1): при первой его ссылке или
+фоновым прогревом после старта бота (preload), если ссылка ещё не пришла.
+"""
+import asyncio
+import importlib
+import os
+import sys
+import time
+
+from parsers.common import logger
+
+
+def _flag(name):
+    return bool(int(os.getenv(name, '0')))
+
+
+PARSE_PIKABU = _flag('PARSE_PIKABU')
+PIKABU_REGEX = r"(https?://)?(www\.)?pikabu\.ru(/[^\s]*)?|link=https%3A%2F%2Fpikabu\.ru%2F[^\s]+"
+PIKABU_HOSTS = ('pikabu.ru',)
+
+PARSE_REDDIT = _flag('PARSE_REDDIT')
+REDDIT_REGEX = r"(https?://)?(www\.)?reddit\.com/[^\s]+"
+REDDIT_HOSTS = ('reddit.com',)
+
+PARSE_X = _flag('PARSE_X')
+X_REGEX = r"(https?://)?(www\.|mobile\.)?(twitter\.com|x\.com)/\S*?status/\d+"
+X_HOSTS = ('twitter.com', 'x.com')
+
+PARSE_PINTEREST = _flag('PARSE_PINTEREST')
+PINTEREST_REGEX = r"(https?://)?(www\.)?((pinterest\.[a-z.]+/pin/[^\s]+)|(pin\.it/[^\s]+))"
+PINTEREST_HOSTS = ('pinterest.*', 'pin.it')
+
+PARSE_INSTAGRAM = _flag('PARSE_INSTAGRAM')
+INSTAGRAM_REGEX = r"(https?://)?(www\.)?instagram\.com/(reel|reels|p)/[A-Za-z0-9_-]+"
+INSTAGRAM_HOSTS = ('instagram.com',)
+
+
+class Source:
+    """Источник ссылок для LinkDispatcher (поля regex, hosts, enabled) и ленивый вход в его парсер.
+
+    module — модуль в пакете parsers, func — корутина (link, user) -> (title, content);
+    auth_exc — имя исключения модуля «нужна авторизация», на него отвечаем auth_msg.
+    """
+
+    def __init__(self, label, module, func, regex, hosts, enabled, auth_exc=None, auth_msg=None):
+        self.label = label
+        self.module = f'parsers.{module}'
+        self.regex = regex
+        self.hosts = hosts
+        self.enabled = enabled
+        self.auth_msg = auth_msg
+        self._func = func
+        self._auth_exc = auth_exc
+
+    def load(self):
+        module = sys.modules.get(self.module)
+        if module is None:
+            start = time.perf_counter()
+            module = importlib.import_module(self.module)
+            logger.info("Парсер %s загружен за %.0f мс", self.label, (time.perf_counter() - start) * 1000)
+        return module
+
+    @property
+    def loaded(self):
+        return self.module in sys.modules
+
+    async def func(self, link, user):
+        return await getattr(self.load(), self._func)(link, user)
+
+    @property
+    def auth_exc(self):
+        return getattr(self.load(), self._auth_exc) if self._auth_exc else None
+
+
+SOURCES = [
+    Source('Pikabu', 'pikabu', 'get_pikabu_content', PIKABU_REGEX, PIKABU_HOSTS, PARSE_PIKABU),
+    Source('Reddit', 'reddit', 'get_reddit_content', REDDIT_REGEX, REDDIT_HOSTS, PARSE_REDDIT),
+    Source('Twitter/X', 'twitter', 'get_x_content', X_REGEX, X_HOSTS, PARSE_X),
+    Source('Pinterest', 'pinterest', 'get_pinterest_content', PINTEREST_REGEX, PINTEREST_HOSTS, PARSE_PINTEREST),
+    Source(
+        'Instagram', 'instagram', 'get_instagram_content', INSTAGRAM_REGEX, INSTAGRAM_HOSTS, PARSE_INSTAGRAM,
+        'InstagramAuthRequired', 'Этот контент требует авторизации',
+    ),
+]
+
+
+def loaded(module):
+    """Модуль parsers.<module>, если он уже импортирован, иначе None (не импортирует)."""
+    return sys.modules.get(f'parsers.{module}')
+
+
+async def preload():
+    """Импортировать парсеры включённых источников в фоне, не блокируя event loop."""
+    for source in SOURCES:
+        if source.enabled and not source.loaded:
+            await asyncio.to_thread(source.load)
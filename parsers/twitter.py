@@ -1,21 +1,15 @@
-import asyncio
 import math
-import os
 import re
 
-import requests
+from parsers.common import (
+    ContentUnavailable, Variant, build_http_headers, generate_title, http_get, iter_blocks, logger, pick_variant,
+)
 
-from parsers.common import build_http_headers, generate_title, logger
-
-
-PARSE_X = bool(int(os.getenv('PARSE_X', '0')))
-X_REGEX = r"(https?://)?(www\.|mobile\.)?(twitter\.com|x\.com)/\S*?status/\d+"
 
 _STATUS_ID_REGEX = re.compile(r"(?:twitter\.com|x\.com)/\S*?status/(\d+)", re.IGNORECASE)
 _SYNDICATION_URL = "https://cdn.syndication.twimg.com/tweet-result"
 
-# Telegram bot API caps uploads at ~50 MB; keep a margin for the chosen variant.
-_VIDEO_SIZE_CAP = 45 * 1024 * 1024
+_RESOLUTION_REGEX = re.compile(r'/(\d+)x(\d+)/')
 _DEFAULT_UA = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
                "(KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36")
 
@@ -40,28 +34,27 @@ def _syndication_token(tweet_id):
     return re.sub(r"(0+|\.)", "", token)
 
 
-def _pick_video_url(media):
+def _video_variants(media):
+    """mp4 variants from best to worst; size is estimated from bitrate until probed."""
     info = media.get('video_info') or {}
     variants = [v for v in info.get('variants', []) if v.get('content_type') == 'video/mp4' and v.get('bitrate')]
     if not variants:
         fallback = info.get('variants') or []
-        return fallback[0].get('url') if fallback else None
+        return [Variant(fallback[0]['url'])] if fallback and fallback[0].get('url') else []
 
-    variants.sort(key=lambda v: v['bitrate'])
+    variants.sort(key=lambda v: v['bitrate'], reverse=True)
     duration_s = (info.get('duration_millis') or 0) / 1000
-
-    best = variants[0]  # lowest quality as a safe default
+    result = []
     for variant in variants:
-        if duration_s:
-            estimated_bytes = variant['bitrate'] / 8 * duration_s
-            if estimated_bytes <= _VIDEO_SIZE_CAP:
-                best = variant
-        else:
-            best = variant  # no duration info — assume short clip, take best quality
-    return best.get('url')
+        size = int(variant['bitrate'] / 8 * duration_s) if duration_s else None
+        m = _RESOLUTION_REGEX.search(variant['url'])
+        width, height = (int(m.group(1)), int(m.group(2))) if m else (None, None)
+        result.append(Variant(variant['url'], width, height, size))
+    return result
 
 
-def _get_x_content_sync(url, user):
+async def get_x_content(url, user):
+    logger.debug("Get x url %s", url)
     match = _STATUS_ID_REGEX.search(url)
     if not match:
         raise ValueError("Не удалось извлечь id твита из ссылки")
@@ -70,14 +63,20 @@ def _get_x_content_sync(url, user):
 
     headers = {'User-Agent': _DEFAULT_UA, **build_http_headers()}
     params = {'id': tweet_id, 'token': _syndication_token(tweet_id), 'lang': 'en'}
-    response = requests.get(_SYNDICATION_URL, params=params, headers=headers, timeout=30)
+    response = await http_get(_SYNDICATION_URL, params=params, headers=headers, timeout=30)
     if response.status_code in (400, 404):
-        raise ValueError("Твит не найден, удалён или скрыт")
+        raise ContentUnavailable("Твит не найден, удалён или скрыт")
     response.raise_for_status()
-    data = response.json()
+    title, content = _parse_tweet(response.json(), tweet_id, url, user)
+    for block in content:
+        if 'video_variants' in block:
+            block['videos'] = [await pick_variant(v, headers=headers) for v in block.pop('video_variants')]
+    return title, iter_blocks(content)
 
+
+def _parse_tweet(data, tweet_id, url, user):
     if data.get('__typename') == 'TweetTombstone':
-        raise ValueError("Твит недоступен (удалён, защищён или ограничен по возрасту)")
+        raise ContentUnavailable("Твит недоступен (удалён, защищён или ограничен по возрасту)")
 
     title = generate_title(user, url)
     content = []
@@ -94,19 +93,14 @@ def _get_x_content_sync(url, user):
             if img:
                 images.append(img)
         else:  # video / animated_gif
-            video_url = _pick_video_url(media)
-            if video_url:
-                videos.append(video_url)
+            variants = _video_variants(media)
+            if variants:
+                videos.append(variants)
 
     if images:
         content.append({'images': images})
     if videos:
-        content.append({'videos': videos})
+        content.append({'video_variants': videos})  # resolved to URLs by get_x_content
 
     logger.debug("X tweet %s: text=%s, images=%s, videos=%s", tweet_id, bool(text), len(images), len(videos))
     return title, content
-
-
-async def get_x_content(url, user):
-    logger.debug("Get x url %s", url)
-    return await asyncio.to_thread(_get_x_content_sync, url, user)
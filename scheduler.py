@@ -0,0 +1,61 @@
+import asyncio
+import contextlib
+from collections import defaultdict
+
+from parsers.common import logger
+
+
+class ChatScheduler:
+    """Очереди задач по чатам: разные чаты обрабатываются параллельно, внутри чата — по порядку.
+
+    Задача — корутинная функция без аргументов. Ограничения:
+    * max_workers — сколько задач выполняется одновременно по всем чатам;
+    * queue_size — длина очереди одного чата; при переполнении submit() ждёт (backpressure);
+    * source_limit — сколько задач одного источника (Reddit, Instagram, ...) одновременно в работе;
+      задача с несколькими источниками занимает слот каждого из них.
+    """
+
+    def __init__(self, max_workers, queue_size, source_limit):
+        self._workers = asyncio.Semaphore(max_workers)
+        self._queue_size = queue_size
+        self._sources = defaultdict(lambda: asyncio.Semaphore(source_limit))
+        self._queues = {}
+        self._tasks = {}
+
+    def depth(self):
+        """Сколько задач ждёт в очередях всех чатов."""
+        return sum(q.qsize() for q in self._queues.values())
+
+    async def submit(self, chat_id, sources, job):
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = asyncio.Queue(self._queue_size)
+            self._tasks[chat_id] = asyncio.create_task(self._run_chat(chat_id, queue))
+        if queue.full():
+            logger.info("Очередь чата %s заполнена (%s), ждём", chat_id, queue.qsize())
+        await queue.put((sorted(sources), job))
+
+    async def _run_chat(self, chat_id, queue):
+        try:
+            while not queue.empty():
+                sources, job = queue.get_nowait()
+                # Сначала лимиты источников (в одном порядке — без взаимных блокировок), потом
+                # общий: задачи, ждущие медленный источник, не занимают слоты, нужные другим чатам.
+                async with contextlib.AsyncExitStack() as stack:
+                    for source in sources:
+                        await stack.enter_async_context(self._sources[source])
+                    await stack.enter_async_context(self._workers)
+                    try:
+                        await job()
+                    except Exception:
+                        logger.exception("Ошибка задачи %s в чате %s", ', '.join(sources), chat_id)
+        finally:
+            # Между проверкой пустоты и удалением нет await — submit() не потеряет задачу.
+            self._queues.pop(chat_id, None)
+            self._tasks.pop(chat_id, None)
+
+    async def close(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,275 @@
+"""Исходящие вызовы Bot API с учётом лимитов Telegram.
+
+Telegram пропускает от бота примерно 30 сообщений в секунду суммарно, 20 в минуту в одну
+группу и около одного в секунду в личный чат; сверх этого отвечает RetryAfter (flood control).
+Все отправки идут через SendScheduler: он держит лимиты корзинами токенов и не долбит чат,
+который уже получил RetryAfter.
+"""
+import asyncio
+import json
+import time
+import uuid
+
+import httpx
+from telegram import Message
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+from parsers import metrics
+from parsers.common import HTTP_CHUNK_SIZE, http_client, logger
+
+
+TELEGRAM_TEXT_LIMIT = 4096
+# Запас корзины чата: альбом из 10 медиа уходит разом, дальше — со скоростью лимита.
+_CHAT_BURST = 10
+_MAX_IDLE_BUCKETS = 1000
+# Эти вызовы безопасно повторить после таймаута: дубль текста или удаления безвреден. Медиа,
+# которое Telegram уже принял, но не успел подтвердить, повтор запостил бы ещё раз.
+_RETRY_ON_TIMEOUT = frozenset({'send_message', 'delete_message'})
+# Ошибки до отправки запроса: соединение не установлено — Telegram запрос не получил.
+_CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class SourceStreamError(Exception):
+    """Источник оборвал поток посреди загрузки в Telegram — файл до Bot API не дошёл."""
+
+
+def not_delivered(e):
+    """Ошибка отправки, после которой Telegram точно ничего не опубликовал — повтор не даст дубля."""
+    return isinstance(e, SourceStreamError) or isinstance(e.__cause__, _CONNECT_ERRORS)
+
+
+def _seconds(value):
+    return value.total_seconds() if hasattr(value, 'total_seconds') else value
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity в запасе."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._stamp = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def delay(self, cost):
+        """Через сколько секунд наберётся cost токенов; 0 — уже сейчас."""
+        self._refill()
+        return max(0.0, (min(cost, self.capacity) - self._tokens) / self.rate)
+
+    def take(self, cost):
+        self._refill()
+        self._tokens -= min(cost, self.capacity)
+
+    def full(self):
+        self._refill()
+        return self._tokens >= self.capacity
+
+
+class SendScheduler:
+    """Единая точка вызовов Bot API: лимиты, flood control, повторы и отложенные отчёты об ошибках.
+
+    * global_rate — сообщений в секунду на всего бота;
+    * group_per_minute — сообщений в минуту в одну группу (chat_id < 0);
+    * private_rate — сообщений в секунду в личный чат.
+    RetryAfter ставит на паузу все отправки в этот чат, а не только упавший вызов.
+    """
+
+    def __init__(self, global_rate, group_per_minute, private_rate, max_retries=3, retry_delay=5):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._group_rate = group_per_minute / 60
+        self._private_rate = private_rate
+        self._max_retries = max_retries
+        self._retry_delay = retry_delay
+        self._chats = {}
+        self._paused_until = {}
+        self._reports = {}
+        self._report_tasks = {}
+
+    def _bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= _MAX_IDLE_BUCKETS:
+                # Полная корзина ничем не отличается от новой — такие можно забыть.
+                for key in [k for k, b in self._chats.items() if b.full()]:
+                    del self._chats[key]
+            rate = self._group_rate if chat_id < 0 else self._private_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, _CHAT_BURST)
+        return bucket
+
+    def _wait_time(self, chat_id, cost):
+        pause = self._paused_until.get(chat_id, 0) - time.monotonic()
+        return max(pause, self._global.delay(cost), self._bucket(chat_id).delay(cost))
+
+    async def _acquire(self, chat_id, cost):
+        start = time.monotonic()
+        while (wait := self._wait_time(chat_id, cost)) > 0:
+            await asyncio.sleep(wait)
+        # Между проверкой и списанием нет await — токены не уйдут другой задаче.
+        self._global.take(cost)
+        self._bucket(chat_id).take(cost)
+        waited = time.monotonic() - start
+        if waited > 0.01:
+            metrics.SEND_WAIT_SECONDS.observe(waited)
+
+    async def call(self, bot, method, chat_id, cost=1, **kwargs):
+        """bot.<method>(chat_id=chat_id, **kwargs) в пределах лимитов, с повторами.
+
+        cost — сколько сообщений занимает вызов (альбом — по числу медиа, удаление — 0).
+        Повторяет при RetryAfter и сетевых ошибках; BadRequest пробрасывается сразу. Медиа после
+        таймаута или обрыва не повторяется (могло уже дойти) — только если запрос не ушёл (not_delivered).
+        """
+        retry_delay = self._retry_delay
+        for attempt in range(self._max_retries):
+            await self._acquire(chat_id, cost)
+            for value in kwargs.values():
+                if hasattr(value, 'seek'):
+                    value.seek(0)  # файл дочитан предыдущей попыткой
+            try:
+                with metrics.SEND_SECONDS.time(method):
+                    return await getattr(bot, method)(chat_id=chat_id, **kwargs)
+            except BadRequest:
+                raise
+            except RetryAfter as e:
+                metrics.SEND_RETRIES.inc('retry_after')
+                if attempt == self._max_retries - 1:
+                    raise
+                wait = _seconds(e.retry_after)
+                logger.warning("Flood control в чате %s: пауза %s с (%s)", chat_id, wait, method)
+                self._paused_until[chat_id] = max(self._paused_until.get(chat_id, 0), time.monotonic() + wait)
+            except (TimedOut, NetworkError) as e:
+                if attempt == self._max_retries - 1 or (method not in _RETRY_ON_TIMEOUT and not not_delivered(e)):
+                    raise
+                metrics.SEND_RETRIES.inc('network')
+                await asyncio.sleep(retry_delay)
+                retry_delay *= 2
+
+    async def report(self, bot, chat_id, text):
+        """Низкоприоритетное сообщение (отчёт об ошибке). Ошибки отправки только логируются.
+
+        Если чат упёрся в лимит, отчёт откладывается до свободного слота, а накопившиеся к этому
+        времени отчёты чата уходят одним сообщением.
+        """
+        pending = self._reports.get(chat_id)
+        if pending is None and self._wait_time(chat_id, 1) <= 0:
+            await self._send_report(bot, chat_id, text)
+            return
+        if pending is None:
+            pending = self._reports[chat_id] = []
+            self._report_tasks[chat_id] = asyncio.create_task(self._flush_reports(bot, chat_id))
+        pending.append(text)
+
+    async def _flush_reports(self, bot, chat_id):
+        try:
+            while (wait := self._wait_time(chat_id, 1)) > 0:
+                await asyncio.sleep(wait)
+            # Забираем список целиком: отчёты, пришедшие во время отправки, уйдут следующей задачей.
+            texts = self._reports.pop(chat_id)
+            if len(texts) > 1:
+                logger.info("В чат %s уходят %s отложенных отчётов одним сообщением", chat_id, len(texts))
+            text = '\n\n'.join(texts)
+            if len(text) > TELEGRAM_TEXT_LIMIT:
+                text = text[:TELEGRAM_TEXT_LIMIT - 1] + '…'
+            await self._send_report(bot, chat_id, text)
+        finally:
+            # Пока отчёт отправлялся, могли прийти новые: у них свой список и своя задача — их не трогаем.
+            if self._report_tasks.get(chat_id) is asyncio.current_task():
+                del self._report_tasks[chat_id]
+                self._reports.pop(chat_id, None)  # отменены до отправки
+
+    async def _send_report(self, bot, chat_id, text):
+        try:
+            await self.call(bot, 'send_message', chat_id, text=text)
+        except Exception as e:
+            logger.error("Не удалось отправить сообщение в чат: %s", e)
+
+    async def close(self):
+        tasks = list(self._report_tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class StreamUpload:
+    """Файл для Bot API, который читается из ответа источника прямо во время загрузки в Telegram."""
+
+    def __init__(self, url, filename, headers=None):
+        self.url = url
+        self.filename = filename
+        self.headers = headers
+
+
+def _form_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+async def _multipart(boundary, fields, name, upload, client):
+    for key, value in fields.items():
+        yield (f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n'
+               f'{_form_value(value)}\r\n').encode()
+    yield (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{upload.filename}"\r\n'
+           f'Content-Type: application/octet-stream\r\n\r\n').encode()
+    try:
+        async with client.stream('GET', upload.url, headers=upload.headers) as source:
+            source.raise_for_status()
+            async for chunk in source.aiter_bytes(HTTP_CHUNK_SIZE):
+                yield chunk
+    except httpx.HTTPError as e:
+        raise SourceStreamError(f"Источник не отдал видео: {e}") from e
+    yield f'\r\n--{boundary}--\r\n'.encode()
+
+
+class StreamingUploader:
+    """Отправка медиа, которое качается из источника и сразу уходит в multipart-запрос к Bot API.
+
+    Файл не пишется на диск и не собирается в памяти целиком. PTB (HTTPXRequest) собирает тело
+    запроса из готовых байтов, поэтому запрос идёт напрямую через httpx-клиент: по умолчанию общий
+    (parsers.common.http_client), можно передать любой httpx.AsyncClient. Методы повторяют сигнатуры
+    Bot, так что вызываются через SendScheduler.call со всеми лимитами и повторами.
+    """
+
+    def __init__(self, bot, client=None):
+        self._bot = bot
+        self._client = client
+
+    async def _post(self, api_method, chat_id, name, upload, read_timeout=None, write_timeout=None,
+                    connect_timeout=None, pool_timeout=None, **fields):
+        client = self._client or http_client()
+        boundary = uuid.uuid4().hex
+        timeout = httpx.Timeout(connect=connect_timeout, read=read_timeout, write=write_timeout, pool=pool_timeout)
+        try:
+            r = await client.post(
+                f'{self._bot.base_url}/{api_method}',
+                content=_multipart(boundary, {'chat_id': chat_id, **fields}, name, upload, client),
+                headers={'Content-Type': f'multipart/form-data; boundary={boundary}'},
+                timeout=timeout,
+            )
+            data = r.json()
+        except httpx.TimeoutException as e:
+            raise TimedOut(str(e)) from e
+        except httpx.TransportError as e:
+            raise NetworkError(str(e)) from e
+        except ValueError as e:
+            raise NetworkError(f"Bot API вернул не JSON ({r.status_code})") from e
+        if data.get('ok'):
+            return Message.de_json(data['result'], self._bot)
+        description = data.get('description') or f"Bot API вернул {r.status_code}"
+        retry_after = (data.get('parameters') or {}).get('retry_after')
+        if retry_after:
+            raise RetryAfter(retry_after)
+        if data.get('error_code') == 400:
+            raise BadRequest(description)
+        if data.get('error_code') == 403:
+            raise Forbidden(description)
+        raise NetworkError(description)
+
+    async def send_video(self, chat_id, video, **kwargs):
+        return await self._post('sendVideo', chat_id, 'video', video, supports_streaming=True, **kwargs)
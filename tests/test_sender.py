@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+from telegram.error import RetryAfter
+
+from parsers import metrics
+from sender import SendScheduler
+
+
+class SlowBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        await asyncio.sleep(0.2)
+        self.sent.append(text)
+
+
+def test_report_arriving_mid_flush_is_sent():
+    async def run():
+        scheduler = SendScheduler(global_rate=100, group_per_minute=600, private_rate=10)
+        bot = SlowBot()
+        scheduler._bucket(-1).take(10)  # чат упёрся в лимит — отчёты копятся
+        await scheduler.report(bot, -1, 'r1')
+        first = scheduler._report_tasks[-1]
+        while -1 in scheduler._reports:  # ждём, пока первая задача заберёт список и начнёт отправку
+            await asyncio.sleep(0.01)
+        scheduler._bucket(-1).take(10)
+        await scheduler.report(bot, -1, 'r2')
+        second = scheduler._report_tasks[-1]
+        assert second is not first
+        await asyncio.gather(first, second)
+        assert bot.sent == ['r1', 'r2']
+        assert scheduler._reports == {} and scheduler._report_tasks == {}
+
+    asyncio.run(run())
+
+
+def test_retry_after_on_last_attempt_is_counted():
+    class FloodedBot:
+        async def send_message(self, chat_id, text):
+            raise RetryAfter(0)
+
+    async def run():
+        scheduler = SendScheduler(global_rate=100, group_per_minute=600, private_rate=10, max_retries=2)
+        before = metrics.SEND_RETRIES._values.get(('retry_after',), 0)
+        with pytest.raises(RetryAfter):
+            await scheduler.call(FloodedBot(), 'send_message', -1, text='x')
+        assert metrics.SEND_RETRIES._values[('retry_after',)] - before == 2
+
+    asyncio.run(run())
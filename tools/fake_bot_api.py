@@ -0,0 +1,173 @@
+"""Локальная замена сервера Bot API для проверки бота без Telegram.
+
+Понимает то, чем пользуется бот: getMe, getUpdates, sendMessage, sendPhoto, sendVideo,
+sendMediaGroup, deleteMessage (остальные методы просто отвечают ok). Каждый вызов печатается,
+для медиа — откуда взят файл: путь file:// (режим --local настоящего telegram-bot-api),
+multipart-загрузка или ссылка. Входящие сообщения задаются ключом --message и отдаются
+боту через getUpdates один раз.
+
+    python tools/fake_bot_api.py --port 8081 --message "https://x.com/user/status/123"
+    TELEGRAM_API_URL=http://127.0.0.1:8081 python main.py
+
+С --local (по умолчанию) путь file:// проверяется на диске, как это делает настоящий сервер;
+--no-local отвергает такие пути, как публичный Bot API.
+"""
+import argparse
+import itertools
+import json
+import os
+import threading
+import time
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+CHAT = {'id': -100, 'type': 'group', 'title': 'fake'}
+USER = {'id': 1, 'is_bot': False, 'first_name': 'Тестовый'}
+BOT = {'id': 2, 'is_bot': True, 'first_name': 'meme bot', 'username': 'fake_meme_bot'}
+
+_ids = itertools.count(1)
+_lock = threading.Lock()
+
+
+def _next_id():
+    with _lock:
+        return next(_ids)
+
+
+def _read_body(handler):
+    if handler.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        body = bytearray()
+        while size := int(handler.rfile.readline().split(b';')[0].strip(), 16):
+            body += handler.rfile.read(size)
+            handler.rfile.readline()
+        while handler.rfile.readline() not in (b'\r\n', b'\n', b''):
+            pass
+        return bytes(body)
+    return handler.rfile.read(int(handler.headers.get('Content-Length') or 0))
+
+
+def _parse_params(content_type, body):
+    """{поле: str} и {поле: размер загруженного файла} из тела запроса."""
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser().parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+        params, files = {}, {}
+        for part in message.get_payload():
+            name = part.get_param('name', header='content-disposition')
+            payload = part.get_payload(decode=True) or b''
+            if part.get_filename():
+                files[name] = len(payload)
+            else:
+                params[name] = payload.decode()
+        return params, files
+    if content_type.startswith('application/json'):
+        return {k: v if isinstance(v, str) else json.dumps(v) for k, v in json.loads(body or b'{}').items()}, {}
+    return dict(parse_qsl(body.decode())), {}
+
+
+class FakeBotApi:
+    def __init__(self, messages=(), local=True):
+        self.local = local
+        self._updates = [
+            {'update_id': i, 'message': {'message_id': 1000 + i, 'date': int(time.time()), 'chat': CHAT,
+                                         'from': USER, 'text': text}}
+            for i, text in enumerate(messages, 1)
+        ]
+
+    def _file(self, value, files, name):
+        """Описание источника файла для лога; ValueError, если так файл не передать."""
+        if value is None:
+            if name not in files:
+                raise ValueError(f'Bad Request: there is no {name} in the request')
+            return f'multipart, {files[name]} байт'
+        if value.startswith('attach://'):
+            return f'multipart, {files[value[len("attach://"):]]} байт'
+        if value.startswith('file://'):
+            if not self.local:
+                raise ValueError('Bad Request: file:// is available only in local mode')
+            path = unquote(urlsplit(value).path)
+            if not os.path.isfile(path):
+                raise ValueError(f'Bad Request: file {path} not found')
+            return f'путь {path}, {os.path.getsize(path)} байт'
+        return f'ссылка {value}'
+
+    def _message(self, **media):
+        return {'message_id': _next_id(), 'date': int(time.time()), 'chat': CHAT, 'from': BOT, **media}
+
+    def _media(self, kind):
+        file_id = f'{kind}-{_next_id()}'
+        if kind == 'photo':
+            return {'photo': [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 720}]}
+        return {kind: {'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 720, 'duration': 1}}
+
+    def call(self, method, params, files):
+        if method == 'getMe':
+            return BOT
+        if method == 'getUpdates':
+            offset = int(params.get('offset') or 0)
+            pending = [u for u in self._updates if u['update_id'] >= offset]
+            if not pending:
+                time.sleep(min(float(params.get('timeout') or 0), 1))
+            return pending
+        if method == 'sendMessage':
+            print(f"sendMessage: {params.get('text', '')[:80]!r}")
+            return self._message(text=params.get('text', ''))
+        if method in ('sendPhoto', 'sendVideo'):
+            kind = 'photo' if method == 'sendPhoto' else 'video'
+            print(f"{method}: {self._file(params.get(kind), files, kind)}")
+            return self._message(**self._media(kind))
+        if method == 'sendMediaGroup':
+            media = json.loads(params['media'])
+            print(f"sendMediaGroup: {len(media)} шт.")
+            for m in media:
+                print(f"  {m['type']}: {self._file(m['media'], files, None)}")
+            return [self._message(**self._media(m['type'])) for m in media]
+        if method == 'deleteMessage':
+            print(f"deleteMessage: {params.get('message_id')}")
+        return True
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            method = self.path.rstrip('/').rsplit('/', 1)[-1]
+            try:
+                params, files = _parse_params(self.headers.get('Content-Type', ''), _read_body(self))
+                response = {'ok': True, 'result': api.call(method, params, files)}
+            except (KeyError, ValueError) as e:
+                response = {'ok': False, 'error_code': 400, 'description': str(e)}
+            body = json.dumps(response).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = do_POST
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--message', action='append', default=[], help='входящее сообщение (можно несколько)')
+    parser.add_argument('--no-local', dest='local', action='store_false', help='отвергать пути file://')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(FakeBotApi(args.message, args.local)))
+    print(f"Bot API: http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Отправить записанные обновления Telegram в webhook бота — замена Telegram для локальной проверки.
+
+Обновления берутся из JSON-файлов (массив Update или по одному в строке, как их отдаёт getUpdates)
+и/или собираются из текста ключом --text. Каждое уходит POST-запросом с заголовком
+X-Telegram-Bot-Api-Secret-Token, как это делает Telegram; печатается код ответа.
+
+    python tools/fake_bot_api.py                     # Bot API, куда бот будет отвечать
+    TELEGRAM_API_URL=http://127.0.0.1:8081 WEBHOOK_URL=http://127.0.0.1:8443/telegram \\
+        WEBHOOK_SECRET=test python main.py
+    python tools/replay_updates.py --url http://127.0.0.1:8443/telegram --secret test \\
+        --text "https://x.com/user/status/123" updates.json
+"""
+import argparse
+import itertools
+import json
+import sys
+import time
+
+import httpx
+
+
+def load_updates(path):
+    with open(path, encoding='utf-8') as f:
+        text = f.read().strip()
+    if text.startswith('['):
+        return json.loads(text)
+    data = [json.loads(line) for line in text.splitlines() if line.strip()]
+    # Ответ getUpdates целиком: {"ok": true, "result": [...]}
+    if len(data) == 1 and 'result' in data[0]:
+        return data[0]['result']
+    return data
+
+
+def text_update(update_id, text, chat_id):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': int(time.time()), 'text': text,
+            'chat': {'id': chat_id, 'type': 'group' if chat_id < 0 else 'private', 'title': 'replay'},
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'Тестовый'},
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', help='JSON с обновлениями')
+    parser.add_argument('--url', default='http://127.0.0.1:8443/', help='адрес webhook бота')
+    parser.add_argument('--secret', default='', help='WEBHOOK_SECRET бота')
+    parser.add_argument('--text', action='append', default=[], help='сообщение для синтетического Update')
+    parser.add_argument('--chat-id', type=int, default=-100)
+    parser.add_argument('--delay', type=float, default=0, help='пауза между обновлениями, с')
+    args = parser.parse_args()
+
+    ids = itertools.count(int(time.time()))
+    updates = [u for path in args.files for u in load_updates(path)]
+    updates += [text_update(next(ids), text, args.chat_id) for text in args.text]
+    if not updates:
+        parser.error('нет обновлений: укажи файлы или --text')
+
+    failed = 0
+    with httpx.Client(headers={'X-Telegram-Bot-Api-Secret-Token': args.secret}, timeout=30) as client:
+        for update in updates:
+            r = client.post(args.url, json=update)
+            print(f"update {update.get('update_id')}: {r.status_code}")
+            failed += r.status_code != 200
+            time.sleep(args.delay)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
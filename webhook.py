@@ -0,0 +1,93 @@
+"""Приём обновлений Telegram через webhook — локальный HTTP-сервер вместо long polling.
+
+Telegram (или обратный прокси перед ботом: nginx, caddy) POST-ит Update в JSON на путь из
+WEBHOOK_URL. Запрос без правильного X-Telegram-Bot-Api-Secret-Token отклоняется. Принятое
+обновление кладётся в update_queue приложения PTB — дальше его разбирают те же обработчики,
+что и при polling. Соединения keep-alive: Telegram шлёт обновления по нескольким постоянным.
+"""
+import asyncio
+import hmac
+import json
+
+from telegram import Update
+
+from parsers.common import logger
+
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+MAX_BODY = 1024 * 1024
+_IDLE_TIMEOUT = 75
+_REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+            413: 'Payload Too Large'}
+
+
+class WebhookServer:
+    """HTTP-сервер на asyncio, который принимает Update на path и отдаёт их в application.update_queue."""
+
+    def __init__(self, application, path, secret):
+        self._application = application
+        self._path = path
+        self._secret = secret.encode()
+
+    async def start(self, host, port):
+        server = await asyncio.start_server(self._serve, host, port)
+        logger.info("Webhook: слушаем http://%s:%s%s", host, port, self._path)
+        return server
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request = await asyncio.wait_for(self._read_request(reader), _IDLE_TIMEOUT)
+                if request is None:
+                    return
+                status = await self._accept(*request)
+                # Непрочитанное тело (413) оставляет соединение в неизвестном состоянии — закрываем.
+                keep_alive = request[2].get('connection', '').lower() != 'close' and request[3] is not None
+                writer.write(
+                    f'HTTP/1.1 {status} {_REASONS[status]}\r\nContent-Length: 0\r\n'
+                    f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode()
+                )
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        """(method, path, headers, body) или None, если клиент закрыл соединение; body None — слишком большое."""
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length') or 0)
+        if length > MAX_BODY:
+            return method, target.split('?')[0], headers, None
+        body = await reader.readexactly(length) if length else b''
+        return method, target.split('?')[0], headers, body
+
+    async def _accept(self, method, path, headers, body):
+        if path != self._path:
+            return 404
+        if method != 'POST':
+            return 405
+        if body is None:
+            return 413
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, '').encode(), self._secret):
+            logger.warning("Webhook: запрос с неверным секретом отклонён")
+            return 403
+        try:
+            data = json.loads(body)
+            if not isinstance(data, dict):
+                raise ValueError(f"ожидался JSON-объект, получен {type(data).__name__}")
+            update = Update.de_json(data, self._application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            logger.warning("Webhook: не удалось разобрать обновление: %s", e)
+            return 400
+        await self._application.update_queue.put(update)
+        return 200